@@ -0,0 +1,115 @@
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from events import EventEmitter
+from job_control import JobController
+from util import HostLimiter, download_images_from_gallery
+
+# 任务文件中每一行可以使用的字段及其对应的下载参数
+_JOB_FIELDS = {
+    "url": "url",
+    "selector": "gallery_selector",
+    "selector_value": "gallery_selector",
+    "selector_type": "selector_type",
+    "naming": "naming_option",
+    "prefix": "custom_prefix",
+    "save_dir": "save_dir",
+    "next_selector": "next_selector",
+    "max_pages": "max_pages",
+}
+# CSV 中读到的都是字符串，这些字段需要转换为整数
+_INT_FIELDS = {"max_pages"}
+
+
+def load_jobs(path):
+    """读取任务文件，支持 JSONL（每行一个对象）和带表头的 CSV"""
+    jobs = []
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if os.path.splitext(path)[1].lower() == ".csv":
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    for line_no, row in enumerate(rows, 1):
+        job = {}
+        for key, value in row.items():
+            if key in _JOB_FIELDS and value not in (None, ""):
+                job[_JOB_FIELDS[key]] = int(value) if key in _INT_FIELDS else value
+        if "url" not in job or "gallery_selector" not in job:
+            raise ValueError(f"任务文件第 {line_no} 条缺少 url 或 selector")
+        jobs.append(job)
+    return jobs
+
+
+def run_batch(jobs, progress_callback=None, workers=4, per_host_limit=4, parallel_jobs=4, emitter=None,
+              controller=None, **options):
+    """在同一进程中执行多个画廊任务，返回每个任务的统计结果
+
+    所有任务共用 options 中的 session/http_cache、同一个下载线程池（workers
+    为全局并发上限）和按主机的并发限制。parallel_jobs 为同时解析和调度的画廊数。
+    emitter 为共享的 EventEmitter，每个任务的事件带有 job 字段（任务编号）。
+    controller（JobController）暂停或取消时作用于所有任务，每个任务另有自己的子控制器。
+    """
+    emitter = emitter or EventEmitter()
+    controller = controller or JobController()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    host_limiter = HostLimiter(per_host_limit)
+
+    def run_job(number, job):
+        if controller.cancelled:
+            return {"url": job["url"], "error": "已取消"}
+
+        def job_callback(message):
+            if progress_callback:
+                progress_callback(f"[{number}] {message}")
+
+        job_emitter = emitter.child(job=number)
+        params = dict(options)
+        params.update(job)
+        try:
+            return download_images_from_gallery(
+                progress_callback=job_callback,
+                executor=executor,
+                host_limiter=host_limiter,
+                emitter=job_emitter,
+                controller=controller.child(),
+                **params
+            )
+        except Exception as e:
+            job_emitter.emit("job_error", url=job["url"], error=str(e))
+            job_callback(f"任务失败: {e}")
+            return {"url": job["url"], "error": str(e)}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel_jobs)) as job_pool:
+            futures = [job_pool.submit(run_job, number, job) for number, job in enumerate(jobs, 1)]
+            results = [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=True)
+
+    for job, result in zip(jobs, results):
+        result.setdefault("selector", job["gallery_selector"])
+    return results
+
+
+def format_summary(results):
+    """把任务统计整理成便于阅读的多行文本"""
+    lines = ["任务汇总:"]
+    for number, result in enumerate(results, 1):
+        if result.get("error"):
+            lines.append(f"[{number}] {result['url']} 失败: {result['error']}")
+        else:
+            lines.append(
+                f"[{number}] {result['url']} 共 {result['total']} 张, "
+                f"下载 {result['downloaded']}, 未变化 {result['unchanged']}, "
+                f"跳过 {result['skipped']}, 失败 {result['failed']}"
+            )
+    return "\n".join(lines)
+
+
+def write_summary(results, path):
+    """将任务统计写入 JSON 文件"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
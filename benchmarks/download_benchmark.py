@@ -0,0 +1,213 @@
+"""在本地模拟画廊服务器上测量下载吞吐量、单张耗时和内存
+
+每个场景启动一个新的模拟服务器，并在单独的子进程中运行下载器，峰值内存
+只统计下载器本身。结果写入 JSON 文件，可用 --compare 与之前的结果对比。
+
+用法: python benchmarks/download_benchmark.py [--scenarios baseline latency] [--output results.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from gallery_server import GalleryServer, ServerConfig  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 场景名 -> (服务器参数, 下载参数)
+SCENARIOS = {
+    "baseline": ({"images": 200, "image_size": 64 * 1024}, {}),
+    "large": ({"images": 20, "image_size": 4 * 1024 * 1024}, {}),
+    "latency": ({"images": 200, "image_size": 64 * 1024, "latency": 0.05}, {}),
+    "errors": ({"images": 200, "image_size": 64 * 1024, "error_rate": 0.1}, {}),
+    "throttle": ({"images": 100, "image_size": 64 * 1024, "throttle_rate": 0.05}, {}),
+    "slow_body": ({"images": 20, "image_size": 256 * 1024, "body_rate": 512 * 1024}, {}),
+    "paginated": ({"images": 200, "pages": 10, "image_size": 64 * 1024}, {"max_pages": 10}),
+    # 与 slow_large 相同的服务器，大图片分 4 段并发下载
+    "slow_large": ({"images": 4, "image_size": 8 * 1024 * 1024, "body_rate": 2 * 1024 * 1024}, {}),
+    "segmented": ({"images": 4, "image_size": 8 * 1024 * 1024, "body_rate": 2 * 1024 * 1024},
+                  {"segments": 4, "segment_threshold": 1024 * 1024}),
+}
+
+
+def percentile(values, q):
+    """最近秩法计算分位数，没有数据时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def peak_rss():
+    """返回当前进程的峰值常驻内存(字节)，不支持的平台返回 None"""
+    # Linux 的 ru_maxrss 在 exec 后仍保留父进程的峰值，优先读取 VmHWM
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 的单位是 KB，macOS 是字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_child(spec):
+    """在子进程中执行一次下载，返回测量结果"""
+    from rate_limit import HostRateLimiter
+    from util import download_images_from_gallery
+
+    durations, ttfbs = [], []
+    counts = {"bytes": 0, "retries": 0, "failed": 0}
+
+    def on_event(event):
+        # 下载线程会同时调用，list.append 和整数累加在 GIL 下足够安全
+        if event["event"] == "image_done":
+            durations.append(event["elapsed"])
+            ttfbs.append(event["ttfb"])
+            counts["bytes"] += event["bytes"]
+        elif event["event"] == "image_retry":
+            counts["retries"] += 1
+        elif event["event"] == "image_failed":
+            counts["failed"] += 1
+
+    save_dir = tempfile.mkdtemp(prefix="gallery_bench_")
+    options = spec["options"]
+    rate = spec["rate"]
+    try:
+        start = time.perf_counter()
+        stats = download_images_from_gallery(
+            spec["url"],
+            "gallery",
+            save_dir=save_dir,
+            use_cache=False,
+            event_callback=on_event,
+            workers=spec["workers"],
+            per_host_limit=spec["workers"],
+            rate_limiter=HostRateLimiter(initial_rate=rate, max_rate=max(rate, 100.0)) if rate else None,
+            **options
+        )
+        elapsed = time.perf_counter() - start
+        rss = peak_rss()
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    return {
+        "elapsed": elapsed,
+        "downloaded": stats["downloaded"],
+        "failed": counts["failed"],
+        "retries": counts["retries"],
+        "bytes": counts["bytes"],
+        "images_per_second": stats["downloaded"] / elapsed,
+        "mb_per_second": counts["bytes"] / elapsed / 1024 / 1024,
+        "p50_seconds": percentile(durations, 0.5),
+        "p99_seconds": percentile(durations, 0.99),
+        "ttfb_p50_seconds": percentile(ttfbs, 0.5),
+        "peak_rss_mb": None if rss is None else rss / 1024 / 1024,
+        "error": stats["error"],
+    }
+
+
+def run_scenario(name, workers, rate, repeat):
+    """运行一个场景 repeat 次，返回吞吐量居中的那次结果"""
+    server_options, download_options = SCENARIOS[name]
+    runs = []
+    for _ in range(repeat):
+        with GalleryServer(ServerConfig(**server_options)) as server:
+            spec = {"url": server.url, "workers": workers, "rate": rate, "options": download_options}
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)],
+                capture_output=True, text=True, encoding="utf-8", check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result["server"] = server.stats()
+        runs.append(result)
+
+    runs.sort(key=lambda run: run["images_per_second"])
+    result = runs[len(runs) // 2]
+    result["scenario"] = name
+    result["server_config"] = server_options
+    result["runs_images_per_second"] = [run["images_per_second"] for run in runs]
+    return result
+
+
+def _fmt(value, spec, scale=1):
+    return "-" if value is None else format(value * scale, spec)
+
+
+def print_results(results, previous=None):
+    previous = {result["scenario"]: result for result in (previous or [])}
+    print(f"{'场景':<10} {'张/秒':>8} {'MB/秒':>8} {'p50(ms)':>9} {'p99(ms)':>9} "
+          f"{'重试':>5} {'失败':>5} {'峰值内存(MB)':>13}" + (f" {'对比':>8}" if previous else ""))
+    for result in results:
+        line = (
+            f"{result['scenario']:<10} {result['images_per_second']:>8.1f} {result['mb_per_second']:>8.2f} "
+            f"{_fmt(result['p50_seconds'], '>9.1f', 1000)} {_fmt(result['p99_seconds'], '>9.1f', 1000)} "
+            f"{result['retries']:>5} {result['failed']:>5} {_fmt(result['peak_rss_mb'], '>13.1f')}"
+        )
+        old = previous.get(result["scenario"])
+        if old and old["images_per_second"]:
+            change = result["images_per_second"] / old["images_per_second"] - 1
+            line += f" {change:>+8.1%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='图片下载基准测试（本地模拟服务器）')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='要运行的场景, 默认全部')
+    parser.add_argument('--workers', type=int, default=8, help='下载线程数, 默认为 8')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='每个主机的初始请求速率(次/秒), 默认为 10, 设为 0 时不限速')
+    parser.add_argument('--repeat', type=int, default=1, help='每个场景重复次数, 取吞吐量中位数, 默认为 1')
+    parser.add_argument('--output', default='bench_results.json', help='结果 JSON 文件, 默认为 bench_results.json')
+    parser.add_argument('--compare', help='与之前保存的结果 JSON 对比吞吐量')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child))))
+        return
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)["results"]
+
+    results = []
+    for name in args.scenarios:
+        print(f"运行场景: {name}", file=sys.stderr)
+        results.append(run_scenario(name, args.workers, args.rate, max(1, args.repeat)))
+
+    print_results(results, previous)
+    report = {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workers": args.workers,
+        "rate": args.rate,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已写入: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""本地模拟画廊服务器，用于基准测试，不访问真实网站
+
+提供 /gallery/<页码>.html 画廊分页和 /img/<序号>.jpg 图片，可配置图片数量和
+大小、响应延迟、错误率、429 限流比例以及慢速响应体。图片内容由序号确定，
+支持 ETag 和 Range 请求。
+
+单独运行: python benchmarks/gallery_server.py --images 200 --latency 0.05
+"""
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_RANGE_RE = re.compile(r"bytes=(\d+)-(\d*)$")
+
+
+class ServerConfig:
+    """模拟服务器的行为参数
+
+    images 为图片总数，平均分布在 pages 个分页上；image_size 为每张图片的字节数。
+    latency 为每个请求在返回响应头前的延迟（秒），error_rate 和 throttle_rate 为
+    图片请求返回 500 和 429（带 Retry-After: retry_after）的比例。body_rate 不为
+    None 时以该速度（字节/秒）发送图片内容。seed 固定随机数，保证多次运行可比较。
+    """
+
+    def __init__(
+            self,
+            images=100,
+            pages=1,
+            image_size=64 * 1024,
+            latency=0.0,
+            error_rate=0.0,
+            throttle_rate=0.0,
+            retry_after=1,
+            body_rate=None,
+            seed=0
+    ):
+        self.images = images
+        self.pages = max(1, pages)
+        self.image_size = image_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.body_rate = body_rate
+        self.seed = seed
+
+
+class GalleryServer:
+    """在后台线程中运行的模拟画廊服务器，start() 后通过 url 访问"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or ServerConfig()
+        self._random = random.Random(self.config.seed)
+        self._random_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._images = {}
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/gallery/1.html"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "throttled": self.throttled}
+
+    def _image_data(self, number):
+        with self._lock:
+            data = self._images.get(number)
+            if data is None:
+                # 以序号为种子的伪随机内容，不同图片内容不同
+                seed = hashlib.sha256(str(number).encode()).digest()
+                data = (seed * (self.config.image_size // len(seed) + 1))[:self.config.image_size]
+                self._images[number] = data
+            return data
+
+    def _roll(self):
+        with self._random_lock:
+            return self._random.random()
+
+    def gallery_page(self, page):
+        config = self.config
+        per_page = -(-config.images // config.pages)
+        first = (page - 1) * per_page
+        numbers = range(first, min(config.images, first + per_page))
+        images = "".join(f'<figure><img src="/img/{n}.jpg"></figure>' for n in numbers)
+        next_link = f'<a rel="next" href="/gallery/{page + 1}.html">下一页</a>' if page < config.pages else ""
+        return (
+            f"<html><head><title>第 {page} 页</title></head><body>"
+            f'<div id="gallery" class="gallery">{images}</div>{next_link}</body></html>'
+        ).encode("utf-8")
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b"", headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self._write_body(body)
+
+            def _write_body(self, body):
+                rate = server.config.body_rate
+                if not rate:
+                    self.wfile.write(body)
+                    return
+                # 每 0.05 秒发送一小块，模拟慢速连接
+                step = max(1, int(rate * 0.05))
+                for i in range(0, len(body), step):
+                    self.wfile.write(body[i:i + step])
+                    self.wfile.flush()
+                    time.sleep(0.05)
+
+            def do_GET(self):
+                config = server.config
+                with server._lock:
+                    server.requests += 1
+                if config.latency:
+                    time.sleep(config.latency)
+
+                match = re.match(r"/gallery/(\d+)\.html$", self.path)
+                if match and 1 <= int(match.group(1)) <= config.pages:
+                    body = server.gallery_page(int(match.group(1)))
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/html; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                match = re.match(r"/img/(\d+)\.jpg$", self.path)
+                if not match or int(match.group(1)) >= config.images:
+                    self._send(404)
+                    return
+
+                roll = server._roll()
+                if roll < config.throttle_rate:
+                    with server._lock:
+                        server.throttled += 1
+                    self._send(429, headers={"Retry-After": str(config.retry_after)})
+                    return
+                if roll < config.throttle_rate + config.error_rate:
+                    with server._lock:
+                        server.errors += 1
+                    self._send(500)
+                    return
+
+                number = int(match.group(1))
+                data = server._image_data(number)
+                etag = f'"img-{number}-{len(data)}"'
+                headers = {"Content-Type": "image/jpeg", "ETag": etag, "Accept-Ranges": "bytes"}
+                if self.headers.get("If-None-Match") == etag:
+                    self._send(304, headers={"ETag": etag})
+                    return
+
+                range_match = _RANGE_RE.match(self.headers.get("Range", ""))
+                if_range = self.headers.get("If-Range")
+                if range_match and (if_range is None or if_range == etag):
+                    start = int(range_match.group(1))
+                    end = int(range_match.group(2)) if range_match.group(2) else len(data) - 1
+                    end = min(end, len(data) - 1)
+                    if start > end:
+                        self._send(416, headers={"Content-Range": f"bytes */{len(data)}"})
+                        return
+                    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+                    self._send(206, data[start:end + 1], headers)
+                    return
+                self._send(200, data, headers)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟画廊服务器')
+    parser.add_argument('--port', type=int, default=8000, help='监听端口, 默认为 8000')
+    parser.add_argument('--images', type=int, default=100, help='图片总数, 默认为 100')
+    parser.add_argument('--pages', type=int, default=1, help='分页数, 默认为 1')
+    parser.add_argument('--image-size', type=int, default=64, help='每张图片大小(KB), 默认为 64')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='图片请求返回 500 的比例')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='图片请求返回 429 的比例')
+    parser.add_argument('--body-rate', type=int, help='图片发送速度(KB/秒), 默认不限制')
+    args = parser.parse_args()
+
+    config = ServerConfig(
+        images=args.images,
+        pages=args.pages,
+        image_size=args.image_size * 1024,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        body_rate=args.body_rate * 1024 if args.body_rate else None
+    )
+    server = GalleryServer(config, port=args.port)
+    print(f"画廊地址: {server.url}  (选择器: id=gallery)")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
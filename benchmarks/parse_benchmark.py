@@ -0,0 +1,131 @@
+"""比较不同 HTML 解析方式在大型画廊网页上的耗时和内存
+
+用法: python benchmarks/parse_benchmark.py [--sizes 1 4] [--repeat 3]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery_parser import GalleryParser, HAS_LXML  # noqa: E402
+
+
+def build_fixture(size_mb, images=500):
+    """生成约 size_mb MB 的网页：大量无关内容中间夹着一个画廊"""
+    filler_block = (
+        '<div class="post"><h2>标题</h2><p>' + "正文内容 " * 40 + '</p>'
+        '<ul>' + ''.join(f'<li><a href="/item/{i}">链接 {i}</a></li>' for i in range(10)) + '</ul>'
+        '<img src="/avatar.png" class="avatar"></div>\n'
+    )
+    blocks = max(1, int(size_mb * 1024 * 1024 / len(filler_block.encode("utf-8"))))
+    # 画廊元素带有多个类名，class 选择器需要匹配其中之一
+    gallery = '<div id="gallery" class="gallery clearfix">' + ''.join(
+        f'<figure><img src="/images/{i}.jpg" alt="图片 {i}"></figure>' for i in range(images)
+    ) + '</div>'
+    half = blocks // 2
+    return (
+        '<html><head><title>fixture</title></head><body>'
+        + filler_block * half + gallery + filler_block * (blocks - half)
+        + '<a rel="next" href="?page=2">下一页</a></body></html>'
+    )
+
+
+def measure(parser, html, repeat, want_links):
+    """返回 (耗时中位数, 峰值内存, 图片数)"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        srcs, _ = parser.parse(html, want_links=want_links)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    parser.parse(html, want_links=want_links)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak, len(srcs or [])
+
+
+def measure_streaming(parser, html, repeat, chunk_size=64 * 1024):
+    """按块喂给增量解析器，返回 (耗时中位数, 峰值内存, 图片数)"""
+    def run():
+        stream_parser = parser.streaming(want_links=True)
+        count = 0
+        for i in range(0, len(html), chunk_size):
+            stream_parser.feed(html[i:i + chunk_size])
+            count += len(stream_parser.pop_images())
+        stream_parser.close()
+        return count + len(stream_parser.pop_images())
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = run()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak, count
+
+
+def check_modes(html, images, backends):
+    """确认各种解析方式用 id 和 class 选择器都能找到全部图片，返回不一致的说明"""
+    problems = []
+    for selector_type in ("id", "class"):
+        for backend in backends:
+            for subtree in (False, True):
+                srcs, _ = GalleryParser("gallery", selector_type, backend=backend, subtree=subtree).parse(html)
+                if len(srcs or []) != images:
+                    problems.append(f"{selector_type} {backend} {'subtree' if subtree else 'full'}: "
+                                    f"{len(srcs or [])} 张")
+        stream_parser = GalleryParser("gallery", selector_type).streaming()
+        stream_parser.feed(html)
+        stream_parser.close()
+        if len(stream_parser.pop_images()) != images:
+            problems.append(f"{selector_type} stream")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTML 解析方式基准测试')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4],
+                        help='测试网页大小(MB), 默认为 1 4')
+    parser.add_argument('--images', type=int, default=500, help='画廊中的图片数, 默认为 500')
+    parser.add_argument('--repeat', type=int, default=3, help='每种方式重复次数, 默认为 3')
+    args = parser.parse_args()
+
+    backends = ["html.parser"] + (["lxml"] if HAS_LXML else [])
+    if not HAS_LXML:
+        print("未安装 lxml，只测试 html.parser\n")
+
+    # 单页: 只提取图片; 翻页: 同时查找 rel=next 链接（多页抓取模式）
+    print(f"{'大小':>6} {'解析器':<12} {'模式':<8} {'单页(ms)':>10} {'翻页(ms)':>10} {'峰值内存(MB)':>14} {'图片数':>8}")
+    for size in args.sizes:
+        html = build_fixture(size, args.images)
+        problems = check_modes(html, args.images, backends)
+        if problems:
+            print("解析结果不一致: " + "; ".join(problems))
+            sys.exit(1)
+        for backend in backends:
+            for subtree in (False, True):
+                gallery_parser = GalleryParser("gallery", "id", backend=backend, subtree=subtree)
+                elapsed, peak, count = measure(gallery_parser, html, args.repeat, want_links=False)
+                crawl_elapsed, _, _ = measure(gallery_parser, html, args.repeat, want_links=True)
+                print(f"{size:>5}M {backend:<12} {'subtree' if subtree else 'full':<8} "
+                      f"{elapsed * 1000:>10.1f} {crawl_elapsed * 1000:>10.1f} "
+                      f"{peak / 1024 / 1024:>14.1f} {count:>8}")
+
+        # 流式解析边读边提取，单页和翻页的开销相同
+        elapsed, peak, count = measure_streaming(GalleryParser("gallery", "id"), html, args.repeat)
+        print(f"{size:>5}M {'HTMLParser':<12} {'stream':<8} "
+              f"{elapsed * 1000:>10.1f} {elapsed * 1000:>10.1f} "
+              f"{peak / 1024 / 1024:>14.1f} {count:>8}")
+
+
+if __name__ == "__main__":
+    main()
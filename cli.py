@@ -1,24 +1,64 @@
 import argparse
+import multiprocessing
+import os
 import signal
 import sys
+import threading
 
 # 导入下载图片的函数
 from util import (
-    download_images_from_gallery
+    download_images_from_gallery, enqueue_gallery, run_queue_worker
 )
+from batch import load_jobs, run_batch, format_summary, write_summary
+from events import EventEmitter, JsonlWriter, Metrics, render_message
+from http_cache import HTTPCache
+from http_session import create_session
+from job_control import JobController
+from postprocess import PostProcessor
+from watch import watch_gallery
+from rate_limit import HostRateLimiter
+from task_queue import TaskQueue
 
 
-# 定义一个回调函数，用于在命令行界面显示进度信息
-def cli_progress_callback(message):
-    print(message)
+_print_lock = threading.Lock()
+# 本次运行的任务控制器，Ctrl+C 时通过它取消下载
+controller = JobController()
 
 
-# 定义一个信号处理器，用于响应用户中断下载的请求
+# 定义一个回调函数，把下载事件转换为文字显示在命令行界面（多个下载线程会同时调用）
+def cli_event_callback(event):
+    message = render_message(event)
+    if message is None:
+        return
+    # 批量模式下的事件带有任务编号，队列模式下带有进程编号
+    if "job" in event:
+        message = f"[{event['job']}] {message}"
+    if "process" in event:
+        message = f"[进程 {event['process']}] {message}"
+    with _print_lock:
+        print(message)
+
+
+# 打印本次运行的吞吐量、延迟分位数和失败率
+def print_metrics(metrics, title=None):
+    summary = metrics.summary()
+    if title:
+        print(title)
+    p50, p99 = summary["p50_seconds"], summary["p99_seconds"]
+    print(f"吞吐量: {summary['images_per_second']:.2f} 张/秒, "
+          f"{summary['bytes_per_second'] / 1024:.1f} KB/秒")
+    if p50 is not None:
+        print(f"单张耗时: p50 {p50:.3f}秒, p99 {p99:.3f}秒")
+    print(f"失败率: {summary['failure_rate']:.1%}")
+
+
+# 定义一个信号处理器，用于响应用户中断下载的请求：第一次取消下载并等待线程退出，再按一次立即退出
 def signal_handler(sig, frame):
-    global stop_download
-    stop_download = True
-    print("\n下载已取消")
-    sys.exit(0)
+    if controller.cancelled:
+        sys.exit(1)
+    controller.cancel()
+    with _print_lock:
+        print("\n正在取消下载，再按一次 Ctrl+C 立即退出")
 
 
 # 主函数，负责处理命令行参数并启动图片下载过程
@@ -29,17 +69,17 @@ def main():
     # 创建命令行参数解析器
     parser = argparse.ArgumentParser(description='图片下载器 CLI 版本')
     # 添加目标网页URL参数
-    parser.add_argument('url', help='目标网页URL')
+    parser.add_argument('url', nargs='?', help='目标网页URL')
     # 添加画廊选择器值参数
-    parser.add_argument('selector_value', help='画廊选择器值')
+    parser.add_argument('selector_value', nargs='?', help='画廊选择器值')
     # 添加选择器类型参数，默认为id
-    parser.add_argument('--selector-type', choices=['id', 'class'], default='id',
-                        help='选择器类型 (id 或 class), 默认为 id')
+    parser.add_argument('--selector-type', choices=['id', 'class', 'css'], default='id',
+                        help='选择器类型 (id、class 或 css), 默认为 id')
     # 添加图片保存目录参数
     parser.add_argument('--save-dir', help='图片保存目录, 默认为 downloaded_images')
     # 添加文件名命名方式参数，默认为original
-    parser.add_argument('--naming', choices=['original', 'uuid', 'timestamp', 'custom'],
-                        default='original', help='文件名命名方式, 默认为 original')
+    parser.add_argument('--naming', choices=['original', 'uuid', 'timestamp', 'custom', 'hash'],
+                        default='original', help='文件名命名方式 (hash 为内容的 SHA-256), 默认为 original')
     # 添加自定义文件名前缀参数，仅在命名方式为custom时使用
     parser.add_argument('--prefix', help='自定义文件名前缀 (当命名方式为 custom 时使用)')
     # 添加下载超时时间参数，默认为15秒
@@ -48,40 +88,392 @@ def main():
     # 添加下载失败重试次数参数，默认为3次
     parser.add_argument('--retries', type=int, default=3,
                         help='下载失败重试次数, 默认为 3')
+    # 添加并发下载线程数参数，默认为4
+    parser.add_argument('--workers', type=int, default=4,
+                        help='并发下载线程数, 默认为 4')
+    # 添加单个主机的并发上限参数，默认为4
+    parser.add_argument('--per-host', type=int, default=4,
+                        help='同一主机的最大并发连接数, 默认为 4')
+    # 添加连接池大小参数，默认与每主机并发数相同
+    parser.add_argument('--pool-size', type=int,
+                        help='每个主机保持的连接数, 默认与 --per-host 相同')
+    # 添加DNS缓存开关
+    parser.add_argument('--dns-cache', action='store_true',
+                        help='缓存 DNS 解析结果')
+    # 添加写盘分块大小参数，默认为64KB
+    parser.add_argument('--chunk-size', type=int, default=64,
+                        help='写入磁盘的分块大小(KB), 默认为 64')
+    # 添加单张图片大小上限参数
+    parser.add_argument('--max-size', type=float,
+                        help='单张图片大小上限(MB), 超出时跳过')
+    # 添加下载记录数据库路径参数
+    parser.add_argument('--index', help='下载记录数据库路径, 默认为 <保存目录>/<域名>/downloaded.sqlite3')
+    # 添加内容哈希开关
+    parser.add_argument('--hash', action='store_true',
+                        help='记录图片内容的 SHA-256')
+    # 添加分段下载参数
+    parser.add_argument('--segments', type=int, default=1,
+                        help='大图片分成几段并发下载, 默认为 1 (不分段)')
+    parser.add_argument('--segment-threshold', type=float, default=16,
+                        help='达到该大小(MB)的图片才分段下载, 默认为 16')
+    # 添加分片输出参数
+    parser.add_argument('--archive', choices=['tar', 'zip'],
+                        help='把图片写入 tar/zip 分片而不是单独的文件')
+    parser.add_argument('--shard-size', type=int, default=1024,
+                        help='每个分片的大小上限(MB), 默认为 1024')
+    # 添加按内容去重参数
+    parser.add_argument('--dedup', choices=['link', 'manifest'],
+                        help='内容与已下载图片相同时不保存新文件: link 创建硬链接, manifest 只记录已有文件的路径')
+    # 添加后处理参数
+    parser.add_argument('--verify', action='store_true',
+                        help='检查下载的图片是否完整, 损坏时重新下载')
+    parser.add_argument('--thumbnail', type=int, metavar='SIZE',
+                        help='生成最长边为 SIZE 像素的缩略图 (需要 Pillow)')
+    parser.add_argument('--webp', action='store_true',
+                        help='另存一份 WebP 格式的图片 (需要 Pillow)')
+    parser.add_argument('--webp-quality', type=int, default=80,
+                        help='WebP 质量 (1-100), 默认为 80')
+    parser.add_argument('--post-workers', type=int,
+                        help='后处理进程数, 默认为 CPU 核数')
+    # 添加HTTP缓存相关参数
+    parser.add_argument('--no-cache', action='store_true',
+                        help='不使用磁盘 HTTP 缓存')
+    parser.add_argument('--cache-dir', help='HTTP 缓存目录, 默认为 <保存目录>/.http_cache')
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='HTTP 缓存大小上限(MB), 默认为 64')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='对已下载的图片发送条件请求, 重新下载有更新的图片')
+    # 添加按主机自适应限速相关参数
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='每个主机的初始请求速率(次/秒), 默认为 10')
+    parser.add_argument('--min-rate', type=float, default=0.5,
+                        help='自适应调整的最低速率(次/秒), 默认为 0.5')
+    parser.add_argument('--max-rate', type=float, default=100.0,
+                        help='自适应调整的最高速率(次/秒), 默认为 100')
+    parser.add_argument('--latency-target', type=float,
+                        help='响应延迟超过该值(秒)时降低速率, 默认不按延迟调整')
+    parser.add_argument('--no-rate-limit', action='store_true',
+                        help='不限制请求速率')
+    # 添加HTML解析相关参数
+    parser.add_argument('--parser', choices=['auto', 'lxml', 'html.parser'], default='auto',
+                        help='HTML 解析器, 默认为 auto (已安装 lxml 时使用 lxml)')
+    parser.add_argument('--subtree', action='store_true',
+                        help='只构建画廊元素的子树, 加快大页面的解析 (css 选择器不适用)')
+    parser.add_argument('--streaming', action='store_true',
+                        help='边接收网页边解析, 发现图片即开始下载 (仅支持 id/class 选择器)')
+    # 添加多页抓取相关参数
+    parser.add_argument('--max-pages', type=int, default=1,
+                        help='沿翻页链接抓取的最大页数, 默认为 1 (只抓取当前页)')
+    parser.add_argument('--next-selector',
+                        help='“下一页”链接的 CSS 选择器, 默认查找 rel=next')
+    parser.add_argument('--page-workers', type=int, default=2,
+                        help='同时抓取的分页数, 默认为 2')
+    # 添加批量任务相关参数
+    parser.add_argument('--watch', type=float, metavar='INTERVAL',
+                        help='持续运行, 每隔 INTERVAL 秒检查一次画廊, 只下载新增的图片')
+    parser.add_argument('--batch', help='批量任务文件 (JSONL 或 CSV), 每行一个画廊')
+    parser.add_argument('--parallel-jobs', type=int, default=4,
+                        help='批量模式下同时处理的画廊数, 默认为 4')
+    parser.add_argument('--summary', help='批量模式下将任务汇总写入该 JSON 文件')
+    # 添加共享任务队列相关参数
+    parser.add_argument('--queue', help='共享任务队列数据库, 多个进程或机器从中领取图片任务')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='队列模式下本机启动的工作进程数, 默认为 1')
+    parser.add_argument('--lease', type=float, default=120,
+                        help='任务租约时长(秒), 进程崩溃后超过该时间由其他进程接手, 默认为 120')
+    parser.add_argument('--idle-timeout', type=float, default=10,
+                        help='队列中没有任务超过该时间(秒)后工作进程退出, 默认为 10')
+    parser.add_argument('--shared-fs', action='store_true',
+                        help='队列数据库位于多台机器共享的网络文件系统上 (不使用 WAL 模式)')
+    # 添加结构化事件和指标输出参数
+    parser.add_argument('--events', help='将下载事件以 JSONL 格式追加写入该文件')
+    parser.add_argument('--metrics-file', help='运行结束时将指标以 Prometheus 文本格式写入该文件')
 
     # 解析命令行参数
     args = parser.parse_args()
 
+    # 检查参数有效性：单个画廊模式需要URL和选择器值，队列模式可以只处理已有的任务
+    if not args.batch and not args.queue and not (args.url and args.selector_value):
+        parser.error("需要提供 url 和 selector_value, 或使用 --batch 指定任务文件")
+    if args.queue and (args.watch or args.archive or args.verify or args.thumbnail or args.webp):
+        parser.error("--queue 不能与 --watch、--archive 或后处理参数同时使用")
+    if args.watch is not None and (args.batch or args.watch <= 0):
+        parser.error("--watch 需要大于 0 的间隔, 且不能与 --batch 同时使用")
+
     # 检查参数有效性：当命名方式为custom且未提供前缀时，显示错误信息并退出
     if args.naming == 'custom' and not args.prefix:
         print("错误: 当使用 custom 命名方式时必须提供 --prefix 参数")
         sys.exit(1)
 
+    # 创建后处理进程池，批量模式下所有任务共用
+    postprocessor = None
+    if args.verify or args.thumbnail or args.webp:
+        try:
+            postprocessor = PostProcessor(
+                workers=args.post_workers,
+                verify=args.verify,
+                thumbnail_size=args.thumbnail,
+                webp_quality=args.webp_quality if args.webp else None
+            )
+        except ValueError as e:
+            print(f"错误: {e}")
+            sys.exit(1)
+
+    # 创建共享的HTTP会话，复用页面和图片请求的连接
+    session = create_session(
+        pool_size=args.pool_size or args.per_host,
+        dns_cache=args.dns_cache
+    )
+
+    # 下载事件同时交给命令行显示、JSONL 文件和指标统计
+    metrics = Metrics()
+    events_writer = JsonlWriter(args.events) if args.events else None
+    emitter = EventEmitter([cli_event_callback, events_writer, metrics])
+
+    # 单个画廊和批量任务共用的下载参数
+    options = dict(
+        selector_type=args.selector_type,
+        save_dir=args.save_dir,
+        naming_option=args.naming,
+        custom_prefix=args.prefix,
+        timeout=args.timeout,
+        max_retries=args.retries,
+        session=session,
+        chunk_size=args.chunk_size * 1024,
+        max_image_size=int(args.max_size * 1024 * 1024) if args.max_size else None,
+        index_path=args.index,
+        hash_content=args.hash,
+        dedup=args.dedup,
+        segments=args.segments,
+        segment_threshold=int(args.segment_threshold * 1024 * 1024),
+        archive=args.archive,
+        shard_size=args.shard_size * 1024 * 1024,
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_size * 1024 * 1024,
+        revalidate=args.revalidate,
+        next_selector=args.next_selector,
+        max_pages=args.max_pages,
+        page_workers=args.page_workers,
+        parser_backend=args.parser,
+        subtree=args.subtree,
+        streaming=args.streaming,
+        emitter=emitter,
+        controller=controller,
+        postprocessor=postprocessor,
+        rate_limiter=create_rate_limiter(args)
+    )
+
+    try:
+        if args.queue:
+            run_queue_mode(args, options)
+        elif args.batch:
+            run_batch_mode(args, options)
+        else:
+            run_single_mode(args, options)
+    finally:
+        if postprocessor:
+            postprocessor.close()
+        if events_writer:
+            events_writer.close()
+
+    # 队列模式下每个进程单独统计，这里只是进程 1 的指标
+    print_metrics(metrics, "进程 1 的指标 (其他进程各自输出):" if args.queue else None)
+    if args.metrics_file:
+        metrics.write_textfile(args.metrics_file)
+        print(f"指标已写入: {args.metrics_file}")
+
+
+# 按命令行参数创建按主机自适应的限速器
+def create_rate_limiter(args):
+    if args.no_rate_limit:
+        return None
+    return HostRateLimiter(
+        initial_rate=args.rate,
+        min_rate=args.min_rate,
+        max_rate=args.max_rate,
+        latency_target=args.latency_target
+    )
+
+
+# 队列工作进程使用的下载参数
+_WORKER_OPTIONS = ("timeout", "max_retries", "session", "chunk_size", "max_image_size", "hash_content",
+                   "dedup", "segments", "segment_threshold", "rate_limiter", "emitter", "controller")
+# 加入队列时使用的参数，任务文件中的字段可以覆盖
+_ENQUEUE_OPTIONS = ("selector_type", "save_dir", "naming_option", "custom_prefix", "timeout", "session",
+                    "next_selector", "max_pages", "page_workers", "parser_backend", "subtree",
+                    "rate_limiter", "emitter", "controller")
+
+
+def open_queue(args):
+    return TaskQueue(args.queue, lease_seconds=args.lease, journal_mode="DELETE" if args.shared_fs else "WAL")
+
+
+# 队列模式：把画廊的图片加入共享队列，再由本机的多个进程（以及其他机器上的进程）共同下载
+def run_queue_mode(args, options):
+    queue = open_queue(args)
+    jobs = []
+    if args.url:
+        jobs.append({"url": args.url, "gallery_selector": args.selector_value})
+    if args.batch:
+        try:
+            jobs.extend(load_jobs(args.batch))
+        except (OSError, ValueError) as e:
+            print(f"错误: 无法读取任务文件: {e}")
+            sys.exit(1)
+    for job in jobs:
+        if controller.cancelled:
+            break
+        params = {key: options[key] for key in _ENQUEUE_OPTIONS}
+        params.update(job)
+        enqueue_gallery(queue=queue, **params)
+
+    counts = queue.counts()
+    print(f"任务队列: {args.queue}, 待处理 {counts['pending']}, 处理中 {counts['leased']}, "
+          f"已完成 {counts['done']}, 失败 {counts['failed']}")
+    print(f"本机工作进程: {args.processes}, 每个进程 {args.workers}线程")
+    print("按 Ctrl+C 取消下载\n")
+
+    processes = [
+        multiprocessing.Process(target=queue_worker_process, args=(args, number))
+        for number in range(2, max(1, args.processes) + 1)
+    ]
+    for process in processes:
+        process.start()
+    worker_options = {key: options[key] for key in _WORKER_OPTIONS}
+    worker_options['emitter'] = options['emitter'].child(process=1)
+    try:
+        run_queue_worker(
+            queue,
+            workers=args.workers,
+            per_host_limit=args.per_host,
+            idle_timeout=args.idle_timeout,
+            **worker_options
+        )
+    finally:
+        for process in processes:
+            process.join()
+        queue.close()
+    print("\n下载已取消" if controller.cancelled else "\n队列处理完成!")
+
+
+# 本机的其他队列工作进程，各自创建会话、限速器和事件输出
+def queue_worker_process(args, number):
+    signal.signal(signal.SIGINT, signal_handler)
+    # 多个进程同时追加同一个文件时行会交错，每个进程写入单独的事件和指标文件
+    events_writer = JsonlWriter(f"{args.events}.{number}") if args.events else None
+    metrics = Metrics()
+    queue = open_queue(args)
+    try:
+        run_queue_worker(
+            queue,
+            workers=args.workers,
+            per_host_limit=args.per_host,
+            session=create_session(pool_size=args.pool_size or args.per_host, dns_cache=args.dns_cache),
+            idle_timeout=args.idle_timeout,
+            timeout=args.timeout,
+            max_retries=args.retries,
+            chunk_size=args.chunk_size * 1024,
+            max_image_size=int(args.max_size * 1024 * 1024) if args.max_size else None,
+            hash_content=args.hash,
+            dedup=args.dedup,
+            segments=args.segments,
+            segment_threshold=int(args.segment_threshold * 1024 * 1024),
+            rate_limiter=create_rate_limiter(args),
+            emitter=EventEmitter([cli_event_callback, events_writer, metrics], process=number),
+            controller=controller
+        )
+    finally:
+        queue.close()
+        if events_writer:
+            events_writer.close()
+
+    with _print_lock:
+        print_metrics(metrics, f"\n进程 {number} 的指标:")
+        if args.metrics_file:
+            metrics.write_textfile(f"{args.metrics_file}.{number}")
+            print(f"指标已写入: {args.metrics_file}.{number}")
+
+
+# 单个画廊模式
+def run_single_mode(args, options):
+
     # 打印下载信息
     print(f"开始下载: {args.url}")
     print(f"选择器: {args.selector_type}={args.selector_value}")
     print(f"保存目录: {args.save_dir or 'downloaded_images'}")
     print(f"命名方式: {args.naming}{' (前缀: ' + args.prefix + ')' if args.naming == 'custom' else ''}")
     print(f"超时: {args.timeout}秒, 重试: {args.retries}次")
+    print(f"并发: {args.workers}线程, 每主机上限: {args.per_host}")
+    if args.watch:
+        print(f"每 {args.watch:g} 秒检查一次画廊更新, 按 Ctrl+C 停止\n")
+        watch_gallery(
+            args.url,
+            args.selector_value,
+            args.watch,
+            workers=args.workers,
+            per_host_limit=args.per_host,
+            **options
+        )
+        print("\n已停止检查")
+        return
     print("按 Ctrl+C 取消下载\n")
 
     # 调用函数执行图片下载
     download_images_from_gallery(
         url=args.url,
         gallery_selector=args.selector_value,
-        selector_type=args.selector_type,
-        save_dir=args.save_dir,
-        naming_option=args.naming,
-        custom_prefix=args.prefix,
-        timeout=args.timeout,
-        max_retries=args.retries,
-        progress_callback=cli_progress_callback
+        workers=args.workers,
+        per_host_limit=args.per_host,
+        **options
     )
 
     # 下载完成后，显示完成信息
-    print("\n下载完成!")
+    print("\n下载已取消" if controller.cancelled else "\n下载完成!")
+
+
+# 批量模式：在同一进程内依次调度任务文件中的所有画廊
+def run_batch_mode(args, options):
+    try:
+        jobs = load_jobs(args.batch)
+    except (OSError, ValueError) as e:
+        print(f"错误: 无法读取任务文件: {e}")
+        sys.exit(1)
+
+    # 所有任务共享同一个HTTP缓存，--no-cache 时各任务都不使用缓存
+    use_cache = options.pop('use_cache')
+    cache_dir = options.pop('cache_dir')
+    cache_max_bytes = options.pop('cache_max_bytes')
+    if use_cache:
+        options['http_cache'] = HTTPCache(
+            cache_dir or os.path.join(args.save_dir or 'downloaded_images', '.http_cache'),
+            cache_max_bytes
+        )
+    else:
+        options['use_cache'] = False
+
+    print(f"批量任务: {args.batch}, 共 {len(jobs)} 个画廊")
+    print(f"全局并发: {args.workers}线程, 每主机上限: {args.per_host}, 同时处理画廊: {args.parallel_jobs}")
+    print("按 Ctrl+C 取消下载\n")
+
+    results = run_batch(
+        jobs,
+        workers=args.workers,
+        per_host_limit=args.per_host,
+        parallel_jobs=args.parallel_jobs,
+        **options
+    )
+    if 'http_cache' in options:
+        options['http_cache'].close()
+
+    print("\n" + format_summary(results))
+    if args.summary:
+        write_summary(results, args.summary)
+        print(f"任务汇总已写入: {args.summary}")
 
 
 # 当脚本直接执行时，调用主函数
 if __name__ == "__main__":
+    # 打包为可执行文件后，队列模式的子进程需要
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,232 @@
+import queue
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urldefrag, urlparse
+
+import requests
+
+from job_control import JobCancelled
+
+
+def limited_get(session, url, rate_limiter=None, controller=None, **kwargs):
+    """经过主机限速器发出 GET 请求，并把响应状态和延迟反馈给限速器
+
+    等待限速期间任务被取消时抛出 JobCancelled。
+    """
+    if rate_limiter is None:
+        return session.get(url, **kwargs)
+    cancelled = (lambda: controller.cancelled) if controller else None
+    if not rate_limiter.acquire(url, cancelled):
+        raise JobCancelled()
+    try:
+        response = session.get(url, **kwargs)
+    except requests.exceptions.RequestException:
+        rate_limiter.feedback(url, None)
+        raise
+    rate_limiter.feedback(
+        url, response.status_code, response.elapsed.total_seconds(), response.headers.get("Retry-After")
+    )
+    return response
+
+
+def fetch_page(session, url, timeout, cache=None, rate_limiter=None, controller=None, skip_unchanged=False):
+    """获取画廊网页的 HTML，有缓存时使用条件请求，304 时直接返回缓存内容
+
+    skip_unchanged 为 True 时 304 返回 None，调用方不需要再解析未变化的网页。
+    """
+    headers = cache.conditional_headers(url) if cache else {}
+    response = limited_get(session, url, rate_limiter, controller, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        if skip_unchanged:
+            cache.record(url, True)
+            return None
+        body = cache.get_body(url)
+        if body is not None:
+            cache.record(url, True)
+            return body.decode("utf-8")
+        # 缓存正文已被淘汰，重新完整获取
+        response = limited_get(session, url, rate_limiter, controller, timeout=timeout)
+    response.raise_for_status()
+    if cache:
+        cache.record(url, False)
+        cache.store(url, response, response.text.encode("utf-8"))
+    return response.text
+
+
+class _Closed(Exception):
+    """调用方已停止读取事件"""
+
+
+class GalleryCrawler:
+    """从起始页开始沿“下一页”链接抓取画廊的所有分页
+
+    页面由后台线程并发获取和解析，解析出的图片通过有界队列交给 events() 的
+    调用方，调用方下载图片的同时后续分页继续抓取；调用方处理不过来时队列写满，
+    解析线程随之暂停。streaming 为 True 时边接收网页边解析，每发现一张图片
+    立即交出，不必等整页下载完成。待抓取队列和已访问集合都以 max_pages 为上限，
+    只跟随与起始页同一主机的链接。controller（JobController）取消时 events() 立即结束。
+    known_pages 为上一次抓取记录的 {分页 URL: (图片数, 翻页链接)}，其中的分页
+    返回 304 时不再解析，直接沿用记录的翻页链接（用于定期检查画廊更新）。
+    """
+
+    def __init__(
+            self,
+            session,
+            start_url,
+            parser,
+            max_pages=1,
+            page_workers=2,
+            timeout=10,
+            cache=None,
+            emitter=None,
+            streaming=False,
+            chunk_size=64 * 1024,
+            queue_size=256,
+            rate_limiter=None,
+            controller=None,
+            known_pages=None
+    ):
+        self.session = session
+        self.start_url = start_url
+        self.parser = parser
+        self.max_pages = max(1, max_pages)
+        self.page_workers = max(1, page_workers)
+        self.timeout = timeout
+        self.cache = cache
+        self.emitter = emitter
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.rate_limiter = rate_limiter
+        self.controller = controller
+        self.known_pages = known_pages or {}
+        self.host = urlparse(start_url).netloc
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._closed = False
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self._closed:
+                    raise _Closed()
+
+    def _crawl_page(self, url):
+        """在线程池中运行：获取并解析一个分页，把事件写入队列"""
+        want_links = self.max_pages > 1
+        try:
+            if self.streaming:
+                count, hrefs = self._stream_page(url, want_links)
+            else:
+                html = fetch_page(
+                    self.session, url, self.timeout, self.cache, self.rate_limiter, self.controller,
+                    skip_unchanged=url in self.known_pages
+                )
+                if html is None:
+                    count, next_pages = self.known_pages[url]
+                    self._put(("page", url, count, next_pages, True))
+                    return
+                srcs, hrefs = self.parser.parse(html, want_links=want_links)
+                count = None if srcs is None else len(srcs)
+                for idx, src in enumerate(srcs or []):
+                    self._put(("image", url, idx, src, count))
+            next_pages = [urldefrag(urljoin(url, href))[0] for href in hrefs]
+            self._put(("page", url, count, next_pages, False))
+        except (_Closed, JobCancelled):
+            pass
+        except Exception as e:
+            # 任何异常都要通知调用方，否则 events() 会一直等待这个分页
+            try:
+                self._put(("error", url, e, None))
+            except _Closed:
+                pass
+
+    def _stream_page(self, url, want_links):
+        """边下载边解析网页，返回 (图片数, 翻页链接)，找不到画廊时图片数为 None"""
+        stream_parser = self.parser.streaming(want_links=want_links)
+        response = limited_get(
+            self.session, url, self.rate_limiter, self.controller, timeout=self.timeout, stream=True
+        )
+        with response, self._track(response):
+            response.raise_for_status()
+            # 响应头未声明编码时按 UTF-8 解码，避免 requests 默认的 ISO-8859-1
+            if "charset" not in response.headers.get("Content-Type", "").lower():
+                response.encoding = "utf-8"
+            count = 0
+            for chunk in response.iter_content(chunk_size=self.chunk_size, decode_unicode=True):
+                if self._closed:
+                    raise _Closed()
+                stream_parser.feed(chunk)
+                for src in stream_parser.pop_images():
+                    self._put(("image", url, count, src, None))
+                    count += 1
+        stream_parser.close()
+        for src in stream_parser.pop_images():
+            self._put(("image", url, count, src, None))
+            count += 1
+        return (count if stream_parser.found_gallery else None), stream_parser.links
+
+    def _track(self, response):
+        if self.controller:
+            return self.controller.track(response)
+        return nullcontext()
+
+    def _wake(self):
+        """任务取消时唤醒等待队列的 events()"""
+        try:
+            self._queue.put_nowait(("cancelled", None))
+        except queue.Full:
+            # 队列非空，events() 不会阻塞，下一次循环就能看到取消
+            pass
+
+    def events(self):
+        """产出抓取事件，事件为四元组：
+
+        ("image", 页面 URL, 序号, 图片 src, 该页图片总数或 None)
+        ("page", 页面 URL, 图片数（找不到画廊时为 None）, 翻页链接, 是否未变化)
+        单个分页失败时报告并继续，起始页失败时抛出异常。
+        """
+        if self.controller:
+            self.controller.on_cancel(self._wake)
+        seen = {self.start_url}
+        frontier = deque([self.start_url])
+        in_flight = 0
+        pool = ThreadPoolExecutor(max_workers=self.page_workers)
+        try:
+            while frontier or in_flight:
+                if self.controller and self.controller.cancelled:
+                    return
+                while frontier and in_flight < self.page_workers:
+                    pool.submit(self._crawl_page, frontier.popleft())
+                    in_flight += 1
+
+                event = self._queue.get()
+                kind, page_url = event[0], event[1]
+                if kind == "cancelled":
+                    return
+                if kind == "image":
+                    yield event
+                    continue
+
+                in_flight -= 1
+                if kind == "error":
+                    if page_url == self.start_url:
+                        raise event[2]
+                    if self.emitter:
+                        self.emitter.emit("page_failed", url=page_url, error=str(event[2]), start=False)
+                    continue
+
+                for next_url in event[3]:
+                    if len(seen) >= self.max_pages:
+                        break
+                    if next_url not in seen and urlparse(next_url).netloc == self.host:
+                        seen.add(next_url)
+                        frontier.append(next_url)
+                yield event
+        finally:
+            self._closed = True
+            if self.controller:
+                self.controller.remove_on_cancel(self._wake)
+            pool.shutdown(wait=True)
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """规范化图片 URL：协议和主机小写、去掉默认端口和片段、查询参数排序"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+class DownloadIndex:
+    """跨运行持久化的下载记录，以规范化 URL 为主键，可按内容哈希查找
+
+    记录保存在 SQLite 中，写入先进入内存缓冲，累计 batch_size 条或超过
+    flush_interval 秒后批量提交。多个线程可共享同一个实例。journal_mode 默认为
+    WAL；数据库位于多台机器共享的网络文件系统上时应使用 DELETE（WAL 依赖同一台
+    机器上的共享内存）。
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=2.0, journal_mode="WAL"):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "url TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, "
+            "sha256 TEXT, downloaded_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_images_sha256 ON images(sha256)")
+        self._conn.commit()
+
+    def get(self, url):
+        """返回已下载图片的保存路径，未下载时返回 None"""
+        key = normalize_url(url)
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key][1]
+            row = self._conn.execute("SELECT path FROM images WHERE url = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def contains(self, url):
+        return self.get(url) is not None
+
+    def find_by_hash(self, sha256):
+        """按内容哈希查找已保存的图片路径"""
+        with self._lock:
+            for record in self._pending.values():
+                if record[3] == sha256:
+                    return record[1]
+            row = self._conn.execute(
+                "SELECT path FROM images WHERE sha256 = ? LIMIT 1", (sha256,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, url, path, size=None, sha256=None):
+        """记录一张已完成的图片，按批量写入数据库"""
+        key = normalize_url(url)
+        with self._lock:
+            self._pending[key] = (key, path, size, sha256, time.time())
+            if len(self._pending) >= self.batch_size \
+                    or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def remove(self, url):
+        """删除一张图片的记录（例如图片损坏需要重新下载）"""
+        key = normalize_url(url)
+        with self._lock:
+            self._pending.pop(key, None)
+            with self._conn:
+                self._conn.execute("DELETE FROM images WHERE url = ?", (key,))
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if self._pending:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO images (url, path, size, sha256, downloaded_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    list(self._pending.values())
+                )
+            self._pending.clear()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,264 @@
+import json
+import os
+import threading
+import time
+
+# 事件类型及其字段：
+#   job_started     url
+#   page_fetched    url, images（找不到画廊时为 None）, unchanged（304 且未重新解析）, selector_type, selector
+#   page_failed     url, error, start（是否为起始页）
+#   image_skipped   url, reason（downloaded/unchanged/leased）, position
+#   image_started   url, position, attempt, offset（断点续传的起始字节）
+#   image_retry     url, attempt, error, delay, segment（分段下载时的分段序号）
+#   image_done      url, path, position, bytes, ttfb, elapsed, retries, dedup（None/link/manifest）
+#   image_failed    url, error, reason（error/too_large/filename/write/corrupt）, retries
+#   image_processed url, path, error（进程池异常或写入缩略图/WebP 失败时不为 None）, thumbnail, webp, elapsed
+#   image_corrupt   url, path, error, requeued（是否重新下载）
+#   job_error       url, error
+#   job_cancelled   url, interrupted
+#   job_done        url, total, downloaded, unchanged, skipped, failed, cache_hits, cache_misses
+#   job_queued      url, total, queued（新加入共享队列的任务数）
+#   worker_started  worker（队列工作进程标识）
+#   worker_done     worker, total, downloaded, unchanged, skipped, failed
+#   poll_done       url, poll, new, downloaded, failed, error, elapsed, known, next_in（定期检查模式）
+
+
+def render_message(event):
+    """把事件转换为命令行和图形界面显示的文字，不需要显示的事件返回 None"""
+    kind = event["event"]
+    url = event.get("url")
+    position = event.get("position")
+    if kind == "page_fetched":
+        if event.get("unchanged"):
+            return f"网页未变化: {url}"
+        if event["images"] is None:
+            return f"未找到 {event['selector_type']} 为 '{event['selector']}' 的画廊: {url}"
+        if event["images"] == 0:
+            return f"画廊中没有找到图片: {url}"
+        return f"网页解析完成: {url}, 共 {event['images']} 张"
+    if kind == "page_failed":
+        return f"{'无法访问网页' if event['start'] else '无法访问分页'}: {url}, 错误: {event['error']}"
+    if kind == "image_skipped":
+        if event["reason"] == "unchanged":
+            return f"图片未变化，跳过 ({position}): {url}"
+        if event["reason"] == "leased":
+            return f"图片已由其他进程完成，跳过: {url}"
+        return f"跳过已下载: {url}"
+    if kind == "image_started":
+        if event.get("offset"):
+            return f"断点续传: {url}, 从 {event['offset']} 字节继续"
+        return None
+    if kind == "image_retry":
+        return f"下载失败（第 {event['attempt']} 次重试）: {url}, 错误: {event['error']}"
+    if kind == "image_done":
+        if event.get("dedup") == "link":
+            return f"内容重复，已创建硬链接 ({position}): {event['path']}"
+        if event.get("dedup") == "manifest":
+            return f"内容重复，未保存新文件 ({position}): {event['path']}"
+        return f"下载成功 ({position}): {event['path']}"
+    if kind == "image_failed":
+        reason = event["reason"]
+        if reason == "too_large":
+            return f"图片过大，已跳过: {url}, {event['error']}"
+        if reason == "filename":
+            return f"文件名生成失败: {event['error']}"
+        if reason == "write":
+            return f"写入文件失败: {event['error']}"
+        if reason == "corrupt":
+            return f"重新下载后图片仍然损坏: {url}, {event['error']}"
+        return f"下载失败（重试 {event['retries']} 次）: {url}, 错误: {event['error']}"
+    if kind == "image_processed":
+        if event["error"]:
+            return f"后处理失败: {url}, 错误: {event['error']}"
+        return None
+    if kind == "image_corrupt":
+        action = "重新下载" if event["requeued"] else "放弃"
+        return f"图片损坏，{action}: {event['path']}, {event['error']}"
+    if kind == "job_error":
+        return event["error"]
+    if kind == "job_cancelled":
+        return "\n用户中断下载，程序退出。" if event.get("interrupted") else "用户取消下载，程序退出。"
+    if kind == "job_done":
+        message = (f"完成: 共 {event['total']} 张, 下载 {event['downloaded']}, "
+                   f"未变化 {event['unchanged']}, 跳过 {event['skipped']}, 失败 {event['failed']}")
+        if event.get("cache_hits") is not None:
+            message += f"; 缓存命中 {event['cache_hits']} 次，未命中 {event['cache_misses']} 次"
+        return message
+    if kind == "job_queued":
+        return f"已加入队列: {url}, 共 {event['total']} 张, 新任务 {event['queued']} 个"
+    if kind == "worker_started":
+        return f"工作进程 {event['worker']} 开始处理队列"
+    if kind == "worker_done":
+        return (f"工作进程 {event['worker']} 完成: 处理 {event['total']} 张, 下载 {event['downloaded']}, "
+                f"未变化 {event['unchanged']}, 跳过 {event['skipped']}, 失败 {event['failed']}")
+    if kind == "poll_done":
+        return (f"第 {event['poll']} 次检查完成: 新图片 {event['new']} 张, 下载 {event['downloaded']}, "
+                f"失败 {event['failed']}, 耗时 {event['elapsed']:.2f}秒; {event['next_in']:g} 秒后再次检查")
+    return None
+
+
+class JsonlWriter:
+    """把事件逐行写入 JSONL 文件，可被多个线程共享"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, event):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Histogram:
+    """固定分桶的直方图，可估算分位数"""
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        """按桶内线性插值估算分位数，没有数据时返回 None"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, bound in enumerate(self.buckets):
+            if seen + self.counts[i] >= target:
+                fraction = (target - seen) / self.counts[i] if self.counts[i] else 0
+                return lower + (bound - lower) * fraction
+            seen += self.counts[i]
+            lower = bound
+        return self.buckets[-1]
+
+
+_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_SIZE_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24, 1 << 26)
+
+
+class Metrics:
+    """进程内的计数器和直方图，由事件驱动，可写出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {
+            "pages_fetched_total": 0,
+            "pages_failed_total": 0,
+            "images_downloaded_total": 0,
+            "images_skipped_total": 0,
+            "images_failed_total": 0,
+            "image_retries_total": 0,
+            "images_deduplicated_total": 0,
+            "images_processed_total": 0,
+            "images_corrupt_total": 0,
+            "bytes_downloaded_total": 0,
+        }
+        self.histograms = {
+            "image_ttfb_seconds": Histogram(_LATENCY_BUCKETS),
+            "image_duration_seconds": Histogram(_LATENCY_BUCKETS),
+            "image_size_bytes": Histogram(_SIZE_BUCKETS),
+        }
+
+    def __call__(self, event):
+        kind = event["event"]
+        with self._lock:
+            if kind == "page_fetched":
+                self.counters["pages_fetched_total"] += 1
+            elif kind == "page_failed":
+                self.counters["pages_failed_total"] += 1
+            elif kind == "image_skipped":
+                self.counters["images_skipped_total"] += 1
+            elif kind == "image_retry":
+                self.counters["image_retries_total"] += 1
+            elif kind == "image_failed":
+                self.counters["images_failed_total"] += 1
+            elif kind == "image_processed":
+                self.counters["images_processed_total"] += 1
+            elif kind == "image_corrupt":
+                self.counters["images_corrupt_total"] += 1
+            elif kind == "image_done":
+                self.counters["images_downloaded_total"] += 1
+                self.counters["bytes_downloaded_total"] += event["bytes"]
+                if event.get("dedup"):
+                    self.counters["images_deduplicated_total"] += 1
+                self.histograms["image_ttfb_seconds"].observe(event["ttfb"])
+                self.histograms["image_duration_seconds"].observe(event["elapsed"])
+                self.histograms["image_size_bytes"].observe(event["bytes"])
+
+    def summary(self):
+        """返回吞吐量、延迟分位数和失败率的摘要字典"""
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            done = self.counters["images_downloaded_total"]
+            failed = self.counters["images_failed_total"]
+            duration = self.histograms["image_duration_seconds"]
+            return {
+                "images_per_second": done / elapsed,
+                "bytes_per_second": self.counters["bytes_downloaded_total"] / elapsed,
+                "p50_seconds": duration.quantile(0.5),
+                "p99_seconds": duration.quantile(0.99),
+                "failure_rate": failed / (done + failed) if done + failed else 0.0,
+            }
+
+    def to_prometheus(self, prefix="gallery_downloader_"):
+        lines = []
+        with self._lock:
+            for name, value in self.counters.items():
+                lines.append(f"# TYPE {prefix}{name} counter")
+                lines.append(f"{prefix}{name} {value}")
+            for name, histogram in self.histograms.items():
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}{name}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"{prefix}{name}_sum {histogram.sum}")
+                lines.append(f"{prefix}{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """原子地写出 Prometheus textfile（供 node_exporter 收集）"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+class EventEmitter:
+    """创建带时间戳的事件并分发给所有监听者（JSONL 写入器、Metrics、界面回调等）"""
+
+    def __init__(self, listeners=None, **context):
+        self.listeners = [listener for listener in (listeners or []) if listener]
+        self.context = context
+
+    def child(self, listeners=None, **context):
+        """返回共享现有监听者的新发送器，可附加监听者和上下文字段（如批量任务编号）"""
+        merged = dict(self.context)
+        merged.update(context)
+        return EventEmitter(self.listeners + list(listeners or []), **merged)
+
+    def emit(self, kind, **fields):
+        event = {"event": kind, "time": time.time()}
+        event.update(self.context)
+        event.update(fields)
+        for listener in self.listeners:
+            listener(event)
+        return event
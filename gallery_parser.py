@@ -0,0 +1,154 @@
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+SELECTOR_TYPES = ("id", "class", "css")
+BACKENDS = ("auto", "lxml", "html.parser")
+# 没有结束标签的元素，不会出现在打开元素栈中
+VOID_TAGS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr",
+}
+
+
+def resolve_backend(backend="auto"):
+    """返回 BeautifulSoup 使用的解析器名称，auto 时优先使用 lxml"""
+    if backend == "auto":
+        return "lxml" if HAS_LXML else "html.parser"
+    if backend == "lxml" and not HAS_LXML:
+        raise ValueError("未安装 lxml，请执行 pip install lxml 或改用 html.parser")
+    if backend not in BACKENDS:
+        raise ValueError(f"无效的解析器: {backend}")
+    return backend
+
+
+class GalleryParser:
+    """从画廊网页中提取图片地址和翻页链接
+
+    backend 选择解析器（lxml 明显快于纯 Python 的 html.parser）。subtree 为
+    True 时用 SoupStrainer 只构建画廊元素的子树，大页面上可节省大部分解析时间
+    和内存；css 选择器无法预先过滤，此时仍解析整个文档。需要用 next_selector
+    查找翻页链接时也解析整个文档（只解析一次，比子树加完整文档两次解析更快）。
+    """
+
+    def __init__(self, gallery_selector, selector_type="id", backend="auto", subtree=False, next_selector=None):
+        if selector_type not in SELECTOR_TYPES:
+            raise ValueError("无效的选择器类型，请使用 'id'、'class' 或 'css'")
+        self.gallery_selector = gallery_selector
+        self.selector_type = selector_type
+        self.backend = resolve_backend(backend)
+        self.subtree = subtree and selector_type != "css"
+        self.next_selector = next_selector
+
+    def _strainer(self):
+        if self.selector_type == "id":
+            return SoupStrainer(attrs={"id": self.gallery_selector})
+        # class 属性可能包含多个类名，与 find(class_=...) 一样匹配其中任意一个
+        return SoupStrainer(attrs={"class": self._has_class})
+
+    def _has_class(self, value):
+        return bool(value) and self.gallery_selector in value.split()
+
+    def _find_gallery(self, soup):
+        if self.selector_type == "id":
+            return soup.find(id=self.gallery_selector)
+        if self.selector_type == "class":
+            return soup.find(class_=self.gallery_selector)
+        return soup.select_one(self.gallery_selector)
+
+    def _find_next(self, soup):
+        if self.next_selector:
+            links = soup.select(self.next_selector)
+        else:
+            links = soup.find_all(["a", "link"], rel="next")
+        return [link["href"] for link in links if link.get("href")]
+
+    def parse(self, html, want_links=False):
+        """解析网页，返回 (图片 src 列表, 翻页 href 列表)
+
+        找不到画廊时图片列表为 None；want_links 为 False 时不查找翻页链接。
+        """
+        # 自定义翻页选择器可能匹配任意元素，只能在完整文档中查找
+        subtree = self.subtree and not (want_links and self.next_selector)
+        if subtree:
+            soup = BeautifulSoup(html, self.backend, parse_only=self._strainer())
+        else:
+            soup = BeautifulSoup(html, self.backend)
+
+        gallery = self._find_gallery(soup)
+        srcs = None
+        if gallery is not None:
+            srcs = [img["src"] for img in gallery.find_all("img") if img.get("src")]
+
+        links = []
+        if want_links:
+            if subtree:
+                # 子树模式下翻页链接不在已构建的树中，只需再构建 rel=next 元素
+                soup = BeautifulSoup(html, self.backend, parse_only=SoupStrainer(["a", "link"], attrs={"rel": "next"}))
+            links = self._find_next(soup)
+        return srcs, links
+
+    def streaming(self, want_links=False):
+        """创建对应的增量解析器，只支持 id/class 选择器和 rel=next 翻页"""
+        if self.selector_type == "css":
+            raise ValueError("流式解析不支持 css 选择器，请使用 id 或 class")
+        if want_links and self.next_selector:
+            raise ValueError("流式解析只支持 rel=next 翻页链接")
+        return StreamingGalleryParser(self.gallery_selector, self.selector_type, want_links)
+
+
+class StreamingGalleryParser(HTMLParser):
+    """增量解析画廊网页，每次 feed 后可通过 pop_images() 取出新发现的图片
+
+    只保留画廊内部打开元素的标签栈，内存占用与网页大小无关。与 soup.find
+    一致，只使用第一个匹配的画廊元素。
+    """
+
+    def __init__(self, gallery_selector, selector_type="id", want_links=False):
+        super().__init__(convert_charrefs=True)
+        self.gallery_selector = gallery_selector
+        self.selector_type = selector_type
+        self.want_links = want_links
+        self.found_gallery = False
+        self.links = []
+        self._stack = None
+        self._images = []
+
+    def _matches(self, attrs):
+        if self.selector_type == "id":
+            return attrs.get("id") == self.gallery_selector
+        return self.gallery_selector in (attrs.get("class") or "").split()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.want_links and tag in ("a", "link") and "next" in (attrs.get("rel") or "").split() \
+                and attrs.get("href"):
+            self.links.append(attrs["href"])
+
+        if self._stack is not None:
+            if tag == "img" and attrs.get("src"):
+                self._images.append(attrs["src"])
+            elif tag not in VOID_TAGS:
+                self._stack.append(tag)
+        elif not self.found_gallery and self._matches(attrs):
+            self.found_gallery = True
+            if tag not in VOID_TAGS:
+                self._stack = [tag]
+
+    def handle_endtag(self, tag):
+        # 容忍未闭合的标签：弹出到匹配的开始标签为止
+        if self._stack and tag in self._stack:
+            while self._stack.pop() != tag:
+                pass
+            if not self._stack:
+                self._stack = None
+
+    def pop_images(self):
+        images, self._images = self._images, []
+        return images
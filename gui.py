@@ -1,30 +1,49 @@
+import queue
 import threading
+import time
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 
+from events import render_message
+from job_control import JobController
+from rate_limit import HostRateLimiter
 from util import download_images_from_gallery
 
+# 日志框最多保留的行数，更早的行被删除（可写入日志文件完整保存）
+LOG_MAX_LINES = 5000
+# 每次刷新日志框的间隔（毫秒）和最多处理的消息数
+LOG_INTERVAL_MS = 100
+LOG_BATCH_SIZE = 2000
+
 
 class ImageDownloaderApp:
     def __init__(self, root):
         self.root = root
         self.root.title("图片下载器")
-        self.root.geometry("600x700")
+        self.root.geometry("600x780")
         self.root.resizable(True, True)
 
-        # 状态管理
-        self.is_paused = False
-        self.stop_download = False
+        # 状态管理：每次下载使用新的任务控制器
+        self.controller = None
         self.download_thread = None
 
+        # 下载线程只把事件放入队列，由主线程定时批量取出显示
+        self.log_queue = queue.Queue()
+        self.log_lines = 0
+        self.log_file = None
+        self.log_finished = False
+        self.reset_progress()
+
         # 初始化UI
         self.setup_styles()
         self.create_main_layout()
         self.create_input_frame()
         self.create_advanced_frame()
         self.create_control_buttons()
+        self.create_progress_display()
         self.create_log_display()
         self.setup_grid_weights()
+        self.root.after(LOG_INTERVAL_MS, self.drain_log_queue)
 
     def setup_styles(self):
         """配置UI样式"""
@@ -106,7 +125,7 @@ def create_input_frame(self):
 
         # 选择器类型
         ttk.Label(self.input_frame, text="选择器类型:").grid(row=1, column=0, padx=5, pady=8, sticky="e")
-        self.selector_type = ttk.Combobox(self.input_frame, values=["id", "class"], state="readonly", width=10)
+        self.selector_type = ttk.Combobox(self.input_frame, values=["id", "class", "css"], state="readonly", width=10)
         self.selector_type.grid(row=1, column=1, padx=5, pady=8, sticky="w")
         self.selector_type.set("id")
 
@@ -126,7 +145,7 @@ def create_input_frame(self):
         ttk.Label(self.input_frame, text="命名方式:").grid(row=4, column=0, padx=5, pady=8, sticky="e")
         self.naming_option = ttk.Combobox(
             self.input_frame, 
-            values=["original", "uuid", "timestamp", "custom"], 
+            values=["original", "uuid", "timestamp", "custom", "hash"], 
             state="readonly",
             width=10
         )
@@ -165,6 +184,35 @@ def create_advanced_frame(self):
         self.interval_entry.grid(row=1, column=1, padx=5, pady=8, sticky="w")
         self.interval_entry.insert(0, "0")
 
+        # 并发线程数
+        ttk.Label(self.advanced_frame, text="并发线程数:").grid(row=1, column=2, padx=5, pady=8, sticky="e")
+        self.workers_entry = ttk.Entry(self.advanced_frame, width=10)
+        self.workers_entry.grid(row=1, column=3, padx=5, pady=8, sticky="w")
+        self.workers_entry.insert(0, "4")
+
+        # 每主机并发上限
+        ttk.Label(self.advanced_frame, text="每主机并发:").grid(row=2, column=0, padx=5, pady=8, sticky="e")
+        self.per_host_entry = ttk.Entry(self.advanced_frame, width=10)
+        self.per_host_entry.grid(row=2, column=1, padx=5, pady=8, sticky="w")
+        self.per_host_entry.insert(0, "4")
+
+        # 初始请求速率（次/秒）
+        ttk.Label(self.advanced_frame, text="初始速率（次/秒）:").grid(row=2, column=2, padx=5, pady=8, sticky="e")
+        self.rate_entry = ttk.Entry(self.advanced_frame, width=10)
+        self.rate_entry.grid(row=2, column=3, padx=5, pady=8, sticky="w")
+        self.rate_entry.insert(0, "10")
+
+        # 最高请求速率（次/秒）
+        ttk.Label(self.advanced_frame, text="最高速率（次/秒）:").grid(row=3, column=0, padx=5, pady=8, sticky="e")
+        self.max_rate_entry = ttk.Entry(self.advanced_frame, width=10)
+        self.max_rate_entry.grid(row=3, column=1, padx=5, pady=8, sticky="w")
+        self.max_rate_entry.insert(0, "100")
+
+        # 日志文件（日志框只保留最近的行，完整日志可写入文件）
+        ttk.Label(self.advanced_frame, text="日志文件:").grid(row=3, column=2, padx=5, pady=8, sticky="e")
+        self.log_file_entry = ttk.Entry(self.advanced_frame, width=10)
+        self.log_file_entry.grid(row=3, column=3, padx=5, pady=8, sticky="ew")
+
     def create_control_buttons(self):
         """创建控制按钮框架"""
         self.button_frame = ttk.Frame(self.main_frame)
@@ -179,6 +227,16 @@ def create_control_buttons(self):
         self.cancel_button = ttk.Button(self.button_frame, text="取消", command=self.cancel_download, state=tk.DISABLED)
         self.cancel_button.pack(side=tk.LEFT, padx=5)
 
+    def create_progress_display(self):
+        """创建进度条和吞吐量显示"""
+        self.progress_frame = ttk.Frame(self.main_frame)
+        self.progress_frame.pack(fill=tk.X, pady=(0, 15))
+
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode="determinate")
+        self.progress_bar.pack(fill=tk.X, padx=5)
+        self.progress_label = ttk.Label(self.progress_frame, text="")
+        self.progress_label.pack(fill=tk.X)
+
     def create_log_display(self):
         """创建日志输出框架"""
         self.log_frame = ttk.LabelFrame(
@@ -221,18 +279,91 @@ def browse_directory(self):
             self.save_dir_entry.insert(0, directory)
 
     def log_message(self, message):
-        """在日志框中显示消息"""
+        """在日志框中显示消息，可从任意线程调用"""
+        self.log_queue.put(message)
+
+    def on_event(self, event):
+        """下载线程的事件回调，只放入队列，由主线程处理"""
+        self.log_queue.put(event)
+
+    def reset_progress(self):
+        self.progress = {"total": 0, "done": 0, "failed": 0, "bytes": 0}
+        self.progress_started = time.monotonic()
+
+    def count_event(self, event):
+        """根据事件更新进度计数"""
+        kind = event["event"]
+        if kind == "page_fetched" and event["images"]:
+            self.progress["total"] += event["images"]
+        elif kind in ("image_done", "image_skipped", "image_failed"):
+            self.progress["done"] += 1
+            if kind == "image_failed":
+                self.progress["failed"] += 1
+            elif kind == "image_done":
+                self.progress["bytes"] += event["bytes"]
+
+    def drain_log_queue(self):
+        """在主线程中批量取出日志消息，一次性写入日志框并刷新进度"""
+        lines = []
+        counted = False
+        for _ in range(LOG_BATCH_SIZE):
+            try:
+                item = self.log_queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, dict):
+                self.count_event(item)
+                counted = True
+                item = render_message(item)
+                if item is None:
+                    continue
+            lines.append(item)
+
+        if lines:
+            self.append_log(lines)
+        if counted:
+            self.update_progress()
+        if self.log_finished and self.log_queue.empty():
+            self.close_log_file()
+        # 积压较多时尽快继续处理
+        self.root.after(1 if self.log_queue.qsize() else LOG_INTERVAL_MS, self.drain_log_queue)
+
+    def append_log(self, lines):
+        text = "\n".join(lines) + "\n"
+        if self.log_file:
+            self.log_file.write(text)
+
+        # 只有用户停留在底部时才自动滚动，方便查看历史日志
+        at_bottom = self.log_text.yview()[1] >= 1.0
         self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, message + "\n")
-        self.log_text.see(tk.END)
+        self.log_text.insert(tk.END, text)
+        self.log_lines += len(lines)
+        if self.log_lines > LOG_MAX_LINES:
+            excess = self.log_lines - LOG_MAX_LINES
+            self.log_text.delete("1.0", f"{excess + 1}.0")
+            self.log_lines = LOG_MAX_LINES
+        if at_bottom:
+            self.log_text.see(tk.END)
         self.log_text.config(state=tk.DISABLED)
 
+    def update_progress(self):
+        progress = self.progress
+        total = max(progress["total"], progress["done"])
+        self.progress_bar.config(maximum=max(1, total), value=progress["done"])
+        elapsed = max(time.monotonic() - self.progress_started, 1e-9)
+        self.progress_label.config(
+            text=f"{progress['done']}/{total} 张, 失败 {progress['failed']}, "
+                 f"{progress['done'] / elapsed:.1f} 张/秒, {progress['bytes'] / elapsed / 1024 / 1024:.2f} MB/秒"
+        )
+
+    def close_log_file(self):
+        self.log_finished = False
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
     def start_download(self):
         """启动下载任务"""
-        import util
-        util.is_paused = False
-        util.stop_download = False
-
         url = self.url_entry.get()
         selector_type = self.selector_type.get()
         selector_value = self.selector_entry.get()
@@ -244,23 +375,44 @@ def start_download(self):
             timeout = int(self.timeout_entry.get())
             max_retries = int(self.retries_entry.get())
             download_interval = float(self.interval_entry.get())
+            workers = int(self.workers_entry.get())
+            per_host_limit = int(self.per_host_entry.get())
+            rate_limiter = HostRateLimiter(
+                initial_rate=float(self.rate_entry.get()),
+                max_rate=float(self.max_rate_entry.get())
+            )
         except ValueError:
-            messagebox.showerror("错误", "超时时间、重试次数和下载间隔必须为数字！")
+            messagebox.showerror("错误", "超时时间、重试次数、下载间隔、并发数和速率必须为数字！")
             return
 
         if not url or not selector_value:
             messagebox.showerror("错误", "请输入目标 URL 和选择器值！")
             return
 
+        self.close_log_file()
+        log_path = self.log_file_entry.get()
+        if log_path:
+            try:
+                self.log_file = open(log_path, "a", encoding="utf-8")
+            except OSError as e:
+                messagebox.showerror("错误", f"无法打开日志文件: {e}")
+                return
+
+        self.reset_progress()
+        self.update_progress()
         self.log_message("开始下载...")
         self.download_button.config(state=tk.DISABLED)
         self.pause_button.config(state=tk.NORMAL)
         self.cancel_button.config(state=tk.NORMAL)
 
         # 启动下载线程
+        self.controller = JobController()
         self.download_thread = threading.Thread(
             target=download_images_from_gallery,
-            args=(url, selector_value, selector_type, save_dir, naming_option, custom_prefix, timeout, max_retries, self.log_message, download_interval),
+            args=(url, selector_value, selector_type, save_dir, naming_option, custom_prefix, timeout, max_retries),
+            kwargs={"download_interval": download_interval, "event_callback": self.on_event,
+                    "workers": workers, "per_host_limit": per_host_limit, "rate_limiter": rate_limiter,
+                    "controller": self.controller},
             daemon=True
         )
         self.download_thread.start()
@@ -270,19 +422,18 @@ def start_download(self):
 
     def pause_download(self):
         """暂停或继续下载"""
-        import util
-        util.is_paused = not util.is_paused
-        if util.is_paused:
-            self.pause_button.config(text="继续")
-            self.log_message("下载已暂停")
-        else:
+        if self.controller.paused:
+            self.controller.resume()
             self.pause_button.config(text="暂停")
             self.log_message("下载已继续")
+        else:
+            self.controller.pause()
+            self.pause_button.config(text="继续")
+            self.log_message("下载已暂停")
 
     def cancel_download(self):
         """取消下载"""
-        import util
-        util.stop_download = True
+        self.controller.cancel()
         self.download_button.config(state=tk.NORMAL)
         self.pause_button.config(state=tk.DISABLED, text="暂停")
         self.cancel_button.config(state=tk.DISABLED)
@@ -297,6 +448,8 @@ def check_thread(self):
             self.pause_button.config(state=tk.DISABLED, text="暂停")
             self.cancel_button.config(state=tk.DISABLED)
             self.log_message("下载完成！")
+            # 日志文件在队列中剩余的消息写入后关闭
+            self.log_finished = True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# 每条记录除正文外的估算开销，用于计算缓存占用
+_ENTRY_OVERHEAD = 256
+
+
+class HTTPCache:
+    """基于 ETag/Last-Modified 的磁盘 HTTP 缓存
+
+    每个 URL 记录校验值，可选保存响应正文（用于画廊网页）。请求时附带
+    If-None-Match/If-Modified-Since，服务器返回 304 即为命中。总占用超过
+    max_bytes 时按最近访问时间淘汰（LRU）。多个线程可共享同一个实例。
+    """
+
+    def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(cache_dir, "cache.sqlite3"), check_same_thread=False, timeout=30
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+            "has_body INTEGER NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed)")
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        self._total = row[0]
+
+    def _body_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".body")
+
+    def conditional_headers(self, url):
+        """返回该 URL 的条件请求头，没有缓存记录时为空字典"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, last_modified FROM entries WHERE url = ?", (url,)
+            ).fetchone()
+        headers = {}
+        if row:
+            if row[0]:
+                headers["If-None-Match"] = row[0]
+            if row[1]:
+                headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def get_body(self, url):
+        """读取缓存的正文并刷新访问时间，不存在时返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT has_body FROM entries WHERE url = ?", (url,)).fetchone()
+            if not row or not row[0]:
+                return None
+            try:
+                with open(self._body_path(url), "rb") as f:
+                    body = f.read()
+            except OSError:
+                self._delete_locked(url)
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time.time(), url))
+        return body
+
+    def store(self, url, response, body=None):
+        """根据响应头记录校验值，body 不为空时同时保存正文"""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+
+        size = _ENTRY_OVERHEAD + (len(body) if body is not None else 0)
+        with self._lock:
+            self._delete_locked(url)
+            if body is not None:
+                with open(self._body_path(url), "wb") as f:
+                    f.write(body)
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO entries (url, etag, last_modified, has_body, size, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, etag, last_modified, int(body is not None), size, time.time())
+                )
+            self._total += size
+            self._evict_locked()
+
+    def record(self, url, hit):
+        """统计一次命中或未命中，命中时刷新访问时间"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                with self._conn:
+                    self._conn.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time.time(), url))
+            else:
+                self.misses += 1
+
+    def summary(self):
+        return f"缓存命中 {self.hits} 次，未命中 {self.misses} 次"
+
+    def _delete_locked(self, url):
+        row = self._conn.execute("SELECT has_body, size FROM entries WHERE url = ?", (url,)).fetchone()
+        if not row:
+            return
+        with self._conn:
+            self._conn.execute("DELETE FROM entries WHERE url = ?", (url,))
+        self._total -= row[1]
+        if row[0]:
+            try:
+                os.remove(self._body_path(url))
+            except FileNotFoundError:
+                pass
+
+    def _evict_locked(self):
+        while self._total > self.max_bytes:
+            row = self._conn.execute("SELECT url FROM entries ORDER BY accessed LIMIT 1").fetchone()
+            if not row:
+                break
+            self._delete_locked(row[0])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
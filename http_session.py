@@ -0,0 +1,69 @@
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 默认请求头，所有页面和图片请求共用
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+
+class DNSCache:
+    """进程级 DNS 解析缓存，替换 socket.getaddrinfo"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._original = None
+
+    def _getaddrinfo(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+        result = self._original(*args, **kwargs)
+        with self._lock:
+            self._cache[key] = (now + self.ttl, result)
+        return result
+
+    def install(self):
+        """开始缓存解析结果，重复调用无副作用"""
+        if self._original is None:
+            self._original = socket.getaddrinfo
+            socket.getaddrinfo = self._getaddrinfo
+
+    def uninstall(self):
+        """恢复原始解析函数"""
+        if self._original is not None:
+            socket.getaddrinfo = self._original
+            self._original = None
+
+
+_dns_cache = DNSCache()
+
+
+def create_session(pool_size=10, headers=None, dns_cache=False, dns_ttl=300, max_hosts=32):
+    """创建复用连接的 HTTP 会话
+
+    pool_size 为每个主机保持的连接数，应不小于该主机的并发下载数；
+    max_hosts 为同时缓存连接池的主机个数。
+    requests.Session 可在多个线程间共享，顺序下载和并发下载都使用同一个会话。
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    if headers:
+        session.headers.update(headers)
+
+    if dns_cache:
+        _dns_cache.ttl = dns_ttl
+        _dns_cache.install()
+    return session
@@ -0,0 +1,140 @@
+import socket
+import threading
+from contextlib import contextmanager
+
+
+class JobCancelled(Exception):
+    """任务已被取消"""
+
+
+class JobController:
+    """控制一个下载任务的暂停、继续和取消
+
+    等待中的线程通过 threading.Event 立即被唤醒，不需要轮询；取消时关闭所有
+    正在接收的响应的连接，下载线程会立刻从读取中返回。每个任务使用独立的控制器，
+    同一进程中的多个任务互不影响；child() 创建的子控制器随父控制器一起暂停、
+    继续和取消（例如批量模式中的每个画廊）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._running.set()
+        self._cancelled = threading.Event()
+        self._responses = set()
+        self._callbacks = []
+        self._children = []
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def child(self):
+        """创建继承当前状态的子控制器"""
+        child = JobController()
+        with self._lock:
+            self._children.append(child)
+            paused, cancelled = self.paused, self.cancelled
+        if cancelled:
+            child.cancel()
+        elif paused:
+            child.pause()
+        return child
+
+    def pause(self):
+        with self._lock:
+            if not self.cancelled:
+                self._running.clear()
+            children = list(self._children)
+        for child in children:
+            child.pause()
+
+    def resume(self):
+        self._running.set()
+        with self._lock:
+            children = list(self._children)
+        for child in children:
+            child.resume()
+
+    def cancel(self):
+        """取消任务：唤醒所有等待的线程，中断正在进行的传输"""
+        with self._lock:
+            self._cancelled.set()
+            # 暂停中的线程也需要醒来才能看到取消
+            self._running.set()
+            responses = list(self._responses)
+            callbacks, self._callbacks = self._callbacks, []
+            children = list(self._children)
+        for response in responses:
+            _abort(response)
+        for callback in callbacks:
+            callback()
+        for child in children:
+            child.cancel()
+
+    def on_cancel(self, callback):
+        """登记取消时调用的函数，已取消时立即调用"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_on_cancel(self, callback):
+        """取消登记的函数，调用方不再需要取消通知时调用，避免长期运行时越积越多"""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait_if_paused(self):
+        """暂停时阻塞到继续或取消，返回是否已被取消"""
+        self._running.wait()
+        return self.cancelled
+
+    def check(self):
+        """已暂停时等待，已取消时抛出 JobCancelled"""
+        if self.wait_if_paused():
+            raise JobCancelled()
+
+    def sleep(self, seconds):
+        """可被取消打断的等待，返回是否已被取消"""
+        if seconds > 0:
+            self._cancelled.wait(seconds)
+        return self.cancelled
+
+    @contextmanager
+    def track(self, response):
+        """在 with 块内登记正在接收的响应，取消时将其中断"""
+        with self._lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self._responses.add(response)
+        if cancelled:
+            _abort(response)
+            raise JobCancelled()
+        try:
+            yield response
+        finally:
+            with self._lock:
+                self._responses.discard(response)
+
+
+def _abort(response):
+    """中断响应的传输
+
+    shutdown 套接字后，阻塞在 recv 中的线程会立即收到连接结束并抛出异常，
+    响应仍由读取它的线程负责关闭；取不到套接字时直接关闭响应。
+    """
+    connection = getattr(getattr(response, "raw", None), "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+            return
+        except OSError:
+            pass
+    response.close()
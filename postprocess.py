@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from util import name_index
+
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+
+def _check_jpeg(data):
+    """从 SOI 开始逐段解析 JPEG，直到最后一个扫描段之后的第一个 EOI，返回错误说明或 None
+
+    标记段按长度跳过；熵编码数据中的 FF00 和 RST 标记不是段的结束。EOI 之后的
+    附加数据不检查，其中偶然出现的标记字节不影响结果。
+    """
+    size = len(data)
+    pos = 2
+    scanned = False
+    while True:
+        if pos >= size:
+            return "JPEG 缺少结束标记"
+        if data[pos] != 0xFF:
+            return "JPEG 标记段损坏"
+        # 标记前可以有任意个填充的 FF
+        while pos < size and data[pos] == 0xFF:
+            pos += 1
+        if pos >= size:
+            return "JPEG 缺少结束标记"
+        marker = data[pos]
+        pos += 1
+        if marker == 0xD9:
+            return None if scanned else "JPEG 缺少图像数据"
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # 没有长度字段的独立标记
+            continue
+        if pos + 2 > size:
+            return "JPEG 缺少结束标记"
+        length = int.from_bytes(data[pos:pos + 2], "big")
+        if length < 2:
+            return "JPEG 标记段损坏"
+        pos += length
+        if marker != 0xDA:
+            continue
+        scanned = True
+        # 跳过扫描段之后的熵编码数据，停在下一个标记处
+        while True:
+            pos = data.find(b"\xff", pos)
+            if pos < 0 or pos + 1 >= size:
+                return "JPEG 缺少结束标记"
+            following = data[pos + 1]
+            if following == 0x00 or 0xD0 <= following <= 0xD7:
+                pos += 2
+            elif following == 0xFF:
+                pos += 1
+            else:
+                break
+
+
+def check_structure(path):
+    """按文件结构检查常见图片格式是否完整，返回错误说明，看起来完整时返回 None
+
+    不需要解码，可以发现下载被截断的 JPEG/PNG/GIF/WebP；结束标记之后的附加数据
+    （例如动态照片附带的视频）不算损坏。无法识别的格式不做判断。
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return "文件为空"
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data.startswith(b"\xff\xd8\xff"):
+        return _check_jpeg(data)
+    elif data.startswith(b"\x89PNG\r\n\x1a\n"):
+        if data.rfind(b"IEND") < 0:
+            return "PNG 缺少 IEND 块"
+    elif data.startswith((b"GIF87a", b"GIF89a")):
+        if b";" not in data[-32:]:
+            return "GIF 缺少结束标记"
+    elif data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        if int.from_bytes(data[4:8], "little") + 8 > size:
+            return "WebP 数据不完整"
+    return None
+
+
+def process_image(path, verify=True, thumbnail_size=None, thumbnail_path=None, webp_quality=None, webp_path=None):
+    """在子进程中处理一张图片：校验、生成缩略图、转换为 WebP，返回结果字典
+
+    结果中 error 不为 None 表示图片损坏。缩略图和 WebP 写入 thumbnail_path 和
+    webp_path，路径由提交方预留，不会覆盖已有文件；写入失败（磁盘已满、不支持
+    的颜色模式等）记录在 output_error 中，不算图片损坏。
+    """
+    started = time.monotonic()
+    result = {"path": path, "error": None, "output_error": None, "thumbnail": None, "webp": None}
+    try:
+        if verify and not HAS_PIL:
+            # 安装了 Pillow 时以完整解码的结果为准
+            result["error"] = check_structure(path)
+        if result["error"] is None and HAS_PIL and (verify or thumbnail_size or webp_quality):
+            with Image.open(path) as image:
+                # 完整解码一次，截断或损坏的数据会在这里抛出异常
+                image.load()
+                result["width"], result["height"] = image.size
+                output = None
+                try:
+                    if thumbnail_path:
+                        output = thumbnail_path
+                        thumbnail = image.convert("RGB")
+                        thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+                        thumbnail.save(thumbnail_path, "JPEG", quality=85)
+                        result["thumbnail"] = thumbnail_path
+                    if webp_path:
+                        output = webp_path
+                        image.save(webp_path, "WEBP", quality=webp_quality)
+                        result["webp"] = webp_path
+                except (OSError, ValueError, KeyError) as e:
+                    # 图片已完整解码，这里的错误来自输出文件，不能当作图片损坏
+                    result["output_error"] = str(e) or type(e).__name__
+                    try:
+                        os.remove(output)
+                    except OSError:
+                        pass
+    except (OSError, ValueError, SyntaxError) as e:
+        # Pillow 对损坏的图片会抛出 OSError、ValueError 或 SyntaxError
+        result["error"] = str(e) or type(e).__name__
+    result["elapsed"] = time.monotonic() - started
+    return result
+
+
+class PostProcessor:
+    """在进程池中对下载完成的图片做后处理，充分利用多核而不占用下载线程
+
+    同时排队的图片最多 max_pending 张，超出时提交方阻塞（背压），避免处理
+    跟不上时内存无限增长。verify 检查图片是否完整（未安装 Pillow 时只检查
+    文件结构），thumbnail_size 生成缩略图，webp_quality 转换为 WebP；后两项
+    需要 Pillow。缩略图和 WebP 分别保存在图片所在目录的 thumbnails 和 webp
+    子目录中，文件名通过目录的 NameIndex 预留；本身已是 WebP 的图片不再转换。
+    可在多个画廊任务之间共享。
+    """
+
+    def __init__(self, workers=None, max_pending=None, verify=True, thumbnail_size=None, webp_quality=None):
+        if (thumbnail_size or webp_quality) and not HAS_PIL:
+            raise ValueError("生成缩略图和转换 WebP 需要 Pillow，请执行 pip install Pillow")
+        self.verify = verify
+        self.thumbnail_size = thumbnail_size
+        self.webp_quality = webp_quality
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        workers = self._pool._max_workers
+        self._slots = threading.BoundedSemaphore(max_pending or workers * 4)
+        # 输出目录的 NameIndex，保持引用以免预留的文件名随实例被回收
+        self._names = {}
+
+    def submit(self, path):
+        """提交一张图片，返回结果的 Future；排队已满时阻塞"""
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(
+                process_image, path, self.verify,
+                self.thumbnail_size, self._output_path(path, "thumbnails", ".jpg") if self.thumbnail_size else None,
+                self.webp_quality, self._output_path(path, "webp", ".webp") if self._wants_webp(path) else None
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _wants_webp(self, path):
+        return bool(self.webp_quality) and os.path.splitext(path)[1].lower() != ".webp"
+
+    def _output_path(self, path, subdir, ext):
+        """在图片所在目录的 subdir 子目录中预留一个不重名的输出文件名"""
+        directory = os.path.join(os.path.dirname(path), subdir)
+        names = self._names.get(directory)
+        if names is None:
+            os.makedirs(directory, exist_ok=True)
+            names = self._names[directory] = name_index(directory)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(directory, names.reserve(stem + ext))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# 这些状态码表示服务器要求降低请求频率
+THROTTLE_STATUS = {429, 503}
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或 HTTP 日期），返回需要等待的秒数，无法解析时返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """第 attempt 次重试（从 0 开始）前的等待时间：指数退避加完全随机抖动"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class _HostState:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        # 尚未遇到限流或高延迟时处于慢启动阶段，速率按倍数增长
+        self.slow_start = True
+
+
+class HostRateLimiter:
+    """按主机的令牌桶限速器，根据响应自动调整速率（AIMD）
+
+    每个主机以 initial_rate 次/秒起步。请求成功且延迟不超过 latency_target
+    （未设置时不看延迟）时提高速率：第一次遇到限流之前每个请求加 1（慢启动，
+    约每秒翻倍），之后每秒约增加 increase；遇到 429/503、连接失败
+    或延迟过高时速率乘以 decrease。速率限制在 [min_rate, max_rate] 之间。
+    服务器返回 Retry-After 时，该主机暂停所有请求，最长 max_block 秒。
+    """
+
+    def __init__(
+            self,
+            initial_rate=10.0,
+            min_rate=0.5,
+            max_rate=100.0,
+            increase=1.0,
+            decrease=0.5,
+            latency_target=None,
+            max_block=300
+    ):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.max_block = max_block
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _state(self, url):
+        host = urlparse(url).netloc
+        state = self._hosts.get(host)
+        if state is None:
+            rate = min(self.max_rate, max(self.min_rate, self.initial_rate))
+            state = self._hosts[host] = _HostState(rate)
+        return state
+
+    def acquire(self, url, cancelled=None):
+        """等待直到可以向该主机发出请求；cancelled() 返回 True 时放弃并返回 False"""
+        while True:
+            with self._lock:
+                state = self._state(url)
+                now = time.monotonic()
+                # 桶容量为一秒的请求数，空闲一段时间后允许小幅突发
+                capacity = max(1.0, state.rate)
+                state.tokens = min(capacity, state.tokens + (now - state.updated) * state.rate)
+                state.updated = now
+                if now < state.blocked_until:
+                    delay = state.blocked_until - now
+                elif state.tokens >= 1:
+                    state.tokens -= 1
+                    return True
+                else:
+                    delay = (1 - state.tokens) / state.rate
+            if cancelled and cancelled():
+                return False
+            time.sleep(min(delay, 0.5))
+
+    def feedback(self, url, status_code=None, latency=None, retry_after=None):
+        """根据一次请求的结果调整速率；status_code 为 None 表示连接失败或超时"""
+        with self._lock:
+            state = self._state(url)
+            throttled = status_code is None or status_code in THROTTLE_STATUS
+            slow = self.latency_target is not None and latency is not None and latency > self.latency_target
+            if throttled or slow:
+                state.rate = max(self.min_rate, state.rate * self.decrease)
+                state.tokens = min(state.tokens, 1.0)
+                state.slow_start = False
+            elif status_code < 400 and state.slow_start:
+                state.rate = min(self.max_rate, state.rate + 1)
+            elif status_code < 400:
+                # 每个请求增加 increase / rate，折合每秒增加约 increase
+                state.rate = min(self.max_rate, state.rate + self.increase / state.rate)
+
+            wait = parse_retry_after(retry_after)
+            if wait:
+                wait = min(wait, self.max_block)
+                state.blocked_until = max(state.blocked_until, time.monotonic() + wait)
+
+    def rate(self, url):
+        """返回该主机当前的速率（次/秒）"""
+        with self._lock:
+            return self._state(url).rate
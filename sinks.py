@@ -0,0 +1,180 @@
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+
+ARCHIVE_FORMATS = ("tar", "zip")
+
+
+class DirectorySink:
+    """把图片作为单独的文件保存到目录中（默认输出方式）
+
+    names 为目录对应的 NameIndex，用于预留不重名的文件名。index 和 dedup
+    用于按内容去重：link 创建硬链接，manifest 只记录已有文件的路径。
+    """
+
+    def __init__(self, directory, names, index=None, dedup=None):
+        self.directory = directory
+        self.names = names
+        self.index = index
+        self.dedup = dedup
+
+    def store(self, part_path, img_url, img_name, sha256=None, content_named=False):
+        """保存下载完成的断点文件，返回 (路径, 去重方式)，去重方式为 None 表示保存了新文件
+
+        content_named 为 True 表示 img_name 由内容哈希生成，同名即同内容。
+        """
+        if content_named:
+            img_path = os.path.join(self.directory, img_name)
+            if os.path.exists(img_path):
+                # 本次下载的文件可以直接丢弃
+                os.remove(part_path)
+                return img_path, "manifest"
+
+        if self.dedup and sha256:
+            existing = self.index.find_by_hash(sha256)
+            if existing and os.path.exists(existing):
+                if self.dedup == "manifest":
+                    os.remove(part_path)
+                    return existing, "manifest"
+                img_path = self._link(existing, img_name)
+                if img_path:
+                    os.remove(part_path)
+                    return img_path, "link"
+
+        return self._move(part_path, img_name), None
+
+    def _move(self, part_path, img_name):
+        """先用硬链接创建目标文件，目标已存在（例如被其他进程写入）时换一个文件名，
+        不会覆盖已有图片；文件系统不支持硬链接时退回 os.replace
+        """
+        while True:
+            img_path = os.path.join(self.directory, img_name)
+            try:
+                os.link(part_path, img_path)
+            except FileExistsError:
+                img_name = self.names.reserve(img_name)
+                continue
+            except OSError:
+                # 同一文件系统内重命名是原子操作，中途崩溃不会留下看似完整的残缺文件
+                os.replace(part_path, img_path)
+                return img_path
+            os.remove(part_path)
+            return img_path
+
+    def _link(self, source, img_name):
+        """创建指向已有图片的硬链接，返回路径，不支持硬链接时返回 None"""
+        while True:
+            img_path = os.path.join(self.directory, img_name)
+            try:
+                os.link(source, img_path)
+                return img_path
+            except FileExistsError:
+                img_name = self.names.reserve(img_name)
+            except OSError:
+                # 跨文件系统或文件系统不支持硬链接
+                return None
+
+    def close(self):
+        pass
+
+
+class ShardSink:
+    """把图片依次写入 tar 或 zip 分片，分片达到 max_bytes 后换新文件
+
+    大量小图片不再各自占用一个文件。每张图片在 index.jsonl 中记录一行：
+    URL、分片文件名、成员名、数据在分片中的偏移和大小，可直接按偏移读取。
+    图片以不压缩的方式存入（图片本身已经压缩）。zip 分片在关闭时才写入
+    中央目录，进程中途退出时应以 index.jsonl 为准。多个下载线程可共享同一实例。
+    """
+
+    def __init__(self, directory, fmt="tar", max_bytes=1024 * 1024 * 1024, index=None, dedup=None, prefix="images"):
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"无效的分片格式: {fmt}")
+        self.directory = directory
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.index = index
+        self.dedup = dedup
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._number = 0
+        self._archive = None
+        self._shard_name = None
+        self._index_file = open(os.path.join(directory, "index.jsonl"), "a", encoding="utf-8")
+
+    def _open_shard(self):
+        # 以独占方式创建，同一目录中已有的分片不会被覆盖
+        while True:
+            name = f"{self.prefix}-{self._number:05d}.{self.fmt}"
+            path = os.path.join(self.directory, name)
+            self._number += 1
+            try:
+                if self.fmt == "tar":
+                    self._archive = tarfile.open(path, "x", format=tarfile.PAX_FORMAT)
+                else:
+                    self._archive = zipfile.ZipFile(path, "x", zipfile.ZIP_STORED, allowZip64=True)
+            except FileExistsError:
+                continue
+            self._shard_name = name
+            return
+
+    def _shard_size(self):
+        if self.fmt == "tar":
+            return self._archive.offset
+        return self._archive.fp.tell()
+
+    def _append(self, part_path, member):
+        """把文件追加到当前分片，返回数据在分片中的偏移"""
+        if self.fmt == "tar":
+            info = tarfile.TarInfo(member)
+            info.size = os.path.getsize(part_path)
+            info.mtime = time.time()
+            with open(part_path, "rb") as f:
+                self._archive.addfile(info, f)
+            # 写入模式下 addfile 不记录数据偏移：数据紧接在头之后，按 512 字节对齐
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            return self._archive.offset - padded
+
+        self._archive.write(part_path, arcname=member)
+        info = self._archive.infolist()[-1]
+        # 本地文件头为 30 字节，其后是文件名和扩展字段
+        return info.header_offset + 30 + len(info.filename.encode("utf-8")) + len(info.extra)
+
+    def store(self, part_path, img_url, img_name, sha256=None, content_named=False):
+        """把下载完成的断点文件写入分片，返回 (引用, 去重方式)，引用形如 分片路径#成员名"""
+        if self.dedup and sha256:
+            existing = self.index.find_by_hash(sha256)
+            if existing:
+                # 分片中的图片无法建立硬链接，只记录已有的位置
+                os.remove(part_path)
+                return existing, "manifest"
+
+        size = os.path.getsize(part_path)
+        with self._lock:
+            if self._archive is None:
+                self._open_shard()
+            shard_name = self._shard_name
+            offset = self._append(part_path, img_name)
+            self._index_file.write(json.dumps({
+                "url": img_url, "shard": shard_name, "member": img_name,
+                "offset": offset, "size": size, "sha256": sha256,
+            }, ensure_ascii=False) + "\n")
+            self._index_file.flush()
+            if self._shard_size() >= self.max_bytes:
+                self._close_shard()
+        os.remove(part_path)
+        return f"{os.path.join(self.directory, shard_name)}#{img_name}", None
+
+    def _close_shard(self):
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+            self._index_file.close()
@@ -0,0 +1,158 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+from download_index import DownloadIndex, normalize_url
+
+
+class LeaseLost(Exception):
+    """图片的租约已被其他进程取得，本次结果不能记录"""
+
+
+class TaskQueue(DownloadIndex):
+    """保存在下载记录数据库中的共享图片任务队列，多个进程（可在不同机器上）共同消费
+
+    进程通过 claim() 领取任务并获得 lease_seconds 秒的租约，heartbeat() 定期续租。
+    进程崩溃后租约过期，任务会被其他进程领取。完成的图片在同一个事务中把任务标记
+    为完成并写入下载记录，只有仍持有租约的进程能写入，每张图片只记录一次。
+    任务失败时重新排队，领取达到 max_attempts 次后标记为失败。
+    任务和下载记录都直接写入数据库，不使用批量缓冲，其他进程立即可见。
+    """
+
+    def __init__(self, path, lease_seconds=120, max_attempts=3, journal_mode="WAL"):
+        super().__init__(path, batch_size=1, journal_mode=journal_mode)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL UNIQUE, source TEXT NOT NULL, "
+            "directory TEXT NOT NULL, name TEXT, position INTEGER, state TEXT NOT NULL DEFAULT 'pending', "
+            "owner TEXT, claim TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, updated REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks(state, lease_until)")
+        self._conn.commit()
+
+    def enqueue(self, tasks):
+        """加入任务，tasks 为 (图片 URL, 保存目录, 文件名, 序号) 的序列
+
+        文件名为 None 时按内容哈希命名。已在队列中或已下载的图片忽略，返回新加入的数量。
+        """
+        now = time.time()
+        rows = [(normalize_url(url), url, directory, name, position, now)
+                for url, directory, name, position in tasks]
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO tasks (url, source, directory, name, position, updated) "
+                "SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM images WHERE url = ?1)",
+                rows
+            )
+            return self._conn.total_changes - before
+
+    def claim(self, limit):
+        """领取最多 limit 个待处理或租约已过期的任务，返回 (图片 URL, 保存目录, 文件名, 序号) 列表"""
+        now = time.time()
+        claim = uuid.uuid4().hex
+        with self._lock:
+            with self._conn:
+                # 单条 UPDATE 在一个写事务中完成选择和占用，多个进程不会领到同一任务
+                self._conn.execute(
+                    "UPDATE tasks SET state = 'leased', owner = ?, claim = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE id IN ("
+                    "SELECT id FROM tasks WHERE state = 'pending' "
+                    "OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT ?)",
+                    (self.worker_id, claim, now + self.lease_seconds, now, now, limit)
+                )
+            rows = self._conn.execute(
+                "SELECT source, directory, name, position FROM tasks WHERE claim = ? ORDER BY id", (claim,)
+            ).fetchall()
+        return rows
+
+    def heartbeat(self):
+        """为本进程持有的所有任务续租"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET lease_until = ? WHERE owner = ? AND state = 'leased'",
+                (now + self.lease_seconds, self.worker_id)
+            )
+
+    def add(self, url, path, size=None, sha256=None):
+        """记录完成的图片并把任务标记为完成，任务已被其他进程领取时抛出 LeaseLost"""
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE tasks SET state = 'done', updated = ? WHERE url = ? AND owner = ? AND state = 'leased'",
+                (now, key, self.worker_id)
+            )
+            if not cursor.rowcount and self._conn.execute(
+                    "SELECT 1 FROM tasks WHERE url = ?", (key,)).fetchone():
+                raise LeaseLost(url)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO images (url, path, size, sha256, downloaded_at) VALUES (?, ?, ?, ?, ?)",
+                (key, path, size, sha256, now)
+            )
+
+    def finish(self, url, outcome):
+        """按下载结果更新本进程持有的任务：跳过或未变化为完成，失败时重新排队，取消时退回"""
+        if outcome == "downloaded":
+            return
+        if outcome in ("skipped", "unchanged"):
+            state = "'done'"
+        elif outcome == "failed":
+            state = f"CASE WHEN attempts >= {int(self.max_attempts)} THEN 'failed' ELSE 'pending' END"
+        else:
+            state = "'pending'"
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE tasks SET state = {state}, owner = NULL, claim = NULL, updated = ?"
+                + (", attempts = attempts - 1" if outcome == "cancelled" else "")
+                + " WHERE url = ? AND owner = ? AND state = 'leased'",
+                (time.time(), normalize_url(url), self.worker_id)
+            )
+
+    def release(self):
+        """把本进程持有的任务退回队列（退出时调用）"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET state = 'pending', owner = NULL, claim = NULL, attempts = attempts - 1 "
+                "WHERE owner = ? AND state = 'leased'",
+                (self.worker_id,)
+            )
+
+    def counts(self):
+        """返回各状态的任务数，租约已过期的任务计入 pending"""
+        now = time.time()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT CASE WHEN state = 'leased' AND lease_until < ? THEN 'pending' ELSE state END, "
+                "COUNT(*) FROM tasks GROUP BY 1", (now,)
+            ).fetchall()
+        counts.update(rows)
+        return counts
+
+
+class LeaseKeeper:
+    """后台线程，每隔租约时长的三分之一为队列中本进程持有的任务续租"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            self.queue.heartbeat()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
@@ -4,31 +4,137 @@
 import time
 import random
 import string
-from bs4 import BeautifulSoup
+import threading
+import hashlib
+import json
+import weakref
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import urljoin, urlparse
 
-# 全局变量
-DOWNLOADED_FILES = set()
-is_paused = False
-stop_download = False
+from crawler import GalleryCrawler, limited_get
+from download_index import DownloadIndex
+from events import EventEmitter, JsonlWriter, render_message
+from gallery_parser import GalleryParser
+from http_cache import HTTPCache
+from http_session import create_session
+from job_control import JobCancelled, JobController
+from sinks import ARCHIVE_FORMATS, DirectorySink, ShardSink
+from task_queue import LeaseKeeper, LeaseLost
+from rate_limit import backoff_delay, parse_retry_after
 
+_state_lock = threading.Lock()
+_PART_LOCKS = {}
+# 目录 -> NameIndex，同一目录的任务共用一个索引，不再使用时自动释放
+_NAME_INDEXES = weakref.WeakValueDictionary()
 
-def load_downloaded_files(save_dir):
-    """加载已下载的文件列表"""
-    if os.path.exists(os.path.join(save_dir, "downloaded.txt")):
-        with open(os.path.join(save_dir, "downloaded.txt"), "r") as f:
-            return set(line.strip() for line in f)
-    return set()
 
+class HostLimiter:
+    """按主机限制同时进行的下载数"""
 
-def save_downloaded_file(save_dir, filename):
-    """保存已下载的文件名"""
-    with open(os.path.join(save_dir, "downloaded.txt"), "a") as f:
-        f.write(f"{filename}\n")
+    def __init__(self, per_host=4):
+        self.per_host = max(1, per_host)
+        self._lock = threading.Lock()
+        self._semaphores = {}
 
+    def _semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
 
-def generate_filename(img_url, naming_option="original", custom_prefix=""):
-    """生成文件名"""
+    @contextmanager
+    def slot(self, url):
+        """占用目标主机的一个并发名额"""
+        semaphore = self._semaphore(url)
+        with semaphore:
+            yield
+
+    @contextmanager
+    def spare_slots(self, url, count):
+        """不等待地再占用目标主机最多 count 个空闲名额，返回实际占用的数量"""
+        semaphore = self._semaphore(url)
+        acquired = 0
+        while acquired < count and semaphore.acquire(blocking=False):
+            acquired += 1
+        try:
+            yield acquired
+        finally:
+            for _ in range(acquired):
+                semaphore.release()
+
+
+class NameIndex:
+    """目录中已占用文件名的内存索引，用于 O(1) 地解决重名
+
+    创建时扫描一次目录，之后只在内存中检查和预留文件名，不再逐个探测文件是否
+    存在。重名时依次尝试 name_1.ext、name_2.ext……，每个基础名记住下一个序号，
+    大量同名图片不会退化为平方复杂度。预留在锁内完成，多个下载线程可以安全共用。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            names = []
+        # Windows 和 macOS 上文件名不区分大小写，按 normcase 比较
+        self._names = {os.path.normcase(name) for name in names}
+        self._next = {}
+
+    def reserve(self, name):
+        """预留一个不重名的文件名并返回"""
+        stem, ext = os.path.splitext(name)
+        with self._lock:
+            candidate = name
+            key = os.path.normcase(name)
+            if key in self._names:
+                counter = self._next.get(key, 1)
+                while True:
+                    candidate = f"{stem}_{counter}{ext}"
+                    if os.path.normcase(candidate) not in self._names:
+                        break
+                    counter += 1
+                self._next[key] = counter + 1
+            self._names.add(os.path.normcase(candidate))
+            return candidate
+
+    def release(self, name):
+        """释放未使用的预留文件名"""
+        with self._lock:
+            self._names.discard(os.path.normcase(name))
+
+
+def name_index(directory):
+    """返回目录对应的 NameIndex，同一进程内共享"""
+    key = os.path.normcase(os.path.abspath(directory))
+    with _state_lock:
+        index = _NAME_INDEXES.get(key)
+        if index is None:
+            index = NameIndex(directory)
+            _NAME_INDEXES[key] = index
+        return index
+
+
+def generate_filename(img_url, naming_option="original", custom_prefix="", names=None, content_hash=None):
+    """生成文件名，传入 names（NameIndex）时预留一个不重名的文件名
+
+    hash 命名使用图片内容的 SHA-256（content_hash），相同内容总是得到相同的
+    文件名，因此不需要预留。
+    """
+    if naming_option == "hash":
+        if not content_hash:
+            raise ValueError("hash 命名需要图片内容的哈希")
+        # 扩展名取自 URL 路径，不含查询参数
+        ext = os.path.splitext(urlparse(img_url).path)[1]
+        return f"{content_hash}{ext}"
+    name = _base_filename(img_url, naming_option, custom_prefix)
+    return names.reserve(name) if names is not None else name
+
+
+def _base_filename(img_url, naming_option, custom_prefix):
     original_name = os.path.basename(img_url)
     name, ext = os.path.splitext(original_name)
 
@@ -45,6 +151,577 @@ def generate_filename(img_url, naming_option="original", custom_prefix=""):
         raise ValueError("Invalid naming option.")
 
 
+class ImageTooLargeError(Exception):
+    """图片超过允许的最大体积"""
+
+
+class _DownloadContext:
+    """单个画廊任务中所有图片共享的下载参数"""
+
+    def __init__(
+            self,
+            save_dir,
+            partial_dir,
+            session,
+            host_limiter,
+            index,
+            names=None,
+            controller=None,
+            cache=None,
+            rate_limiter=None,
+            timeout=10,
+            max_retries=3,
+            emitter=None,
+            download_interval=0,
+            chunk_size=64 * 1024,
+            max_image_size=None,
+            hash_content=False,
+            segments=1,
+            segment_threshold=16 * 1024 * 1024,
+            sink=None,
+            postprocess=None
+    ):
+        self.save_dir = save_dir
+        self.partial_dir = partial_dir
+        self.session = session
+        self.host_limiter = host_limiter
+        self.index = index
+        self.names = names or name_index(save_dir)
+        self.controller = controller or JobController()
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.emitter = emitter or EventEmitter()
+        self.download_interval = download_interval
+        self.chunk_size = chunk_size
+        self.max_image_size = max_image_size
+        self.hash_content = hash_content
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.sink = sink or DirectorySink(save_dir, self.names, index)
+        # 新保存的图片交给后处理，参数为 (idx, total_images, img_url, img_name, img_path)
+        self.postprocess = postprocess
+
+    def emit(self, kind, **fields):
+        return self.emitter.emit(kind, **fields)
+
+
+def _partial_paths(ctx, img_url):
+    """返回图片未完成部分及其校验信息的文件路径，按 URL 固定，跨进程可复用"""
+    key = hashlib.sha1(img_url.encode("utf-8")).hexdigest()
+    part_path = os.path.join(ctx.partial_dir, f"{key}.part")
+    return part_path, part_path + ".json"
+
+
+def _load_validator(meta_path, img_url):
+    """读取断点文件记录的 ETag/Last-Modified"""
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != img_url:
+        return None
+    return meta.get("validator")
+
+
+def _response_validator(response):
+    """取出可用于 If-Range 的强校验值，弱 ETag 不能用于范围请求"""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def _discard_partial(part_path, meta_path):
+    for path in (part_path, meta_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _open_image(ctx, img_url, part_path, meta_path, conditional=False):
+    """发起图片请求，存在可续传的断点文件时带 Range/If-Range，返回 (响应, 起始偏移)
+
+    conditional 为 True 时附带缓存中的校验值，服务器返回 304 时偏移为 None。
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = _load_validator(meta_path, img_url) if offset else None
+    headers = {}
+    if validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    elif conditional and ctx.cache:
+        headers.update(ctx.cache.conditional_headers(img_url))
+
+    response = limited_get(
+        ctx.session, img_url, ctx.rate_limiter, ctx.controller, headers=headers, timeout=ctx.timeout, stream=True
+    )
+    if ctx.cache:
+        ctx.cache.record(img_url, response.status_code == 304)
+    if response.status_code == 304:
+        response.close()
+        return response, None
+    if validator and response.status_code == 416:
+        # 断点文件已失效（例如服务器上的图片变小了），改为完整下载
+        response.close()
+        _discard_partial(part_path, meta_path)
+        response = limited_get(ctx.session, img_url, ctx.rate_limiter, ctx.controller, timeout=ctx.timeout, stream=True)
+    response.raise_for_status()
+
+    if response.status_code == 206:
+        content_range = response.headers.get("Content-Range", "")
+        if content_range.startswith(f"bytes {offset}-"):
+            return response, offset
+        response.close()
+        _discard_partial(part_path, meta_path)
+        raise requests.exceptions.RequestException(f"Content-Range 与断点不符: {content_range}")
+
+    # 服务器忽略了 Range 或图片已变化，从头下载并记录新的校验值
+    _discard_partial(part_path, meta_path)
+    new_validator = _response_validator(response)
+    if new_validator:
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"url": img_url, "validator": new_validator}, f)
+    return response, 0
+
+
+def _hash_file(path, chunk_size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest
+
+
+def _stream_to_part(response, part_path, offset, ctx):
+    """将响应体分块追加到断点文件，出错时保留已写入的部分供下次续传
+
+    暂停时在块之间等待，取消时抛出 JobCancelled。
+    返回 (总字节数, sha256)，未开启 hash_content 时哈希为 None。
+    """
+    content_length = response.headers.get("Content-Length")
+    if ctx.max_image_size and content_length and content_length.isdigit() \
+            and offset + int(content_length) > ctx.max_image_size:
+        raise ImageTooLargeError(f"Content-Length {content_length} 超过上限 {ctx.max_image_size}")
+
+    digest = None
+    if ctx.hash_content:
+        digest = _hash_file(part_path, ctx.chunk_size) if offset else hashlib.sha256()
+
+    written = offset
+    with open(part_path, "ab" if offset else "wb") as f:
+        for chunk in response.iter_content(chunk_size=ctx.chunk_size):
+            if not chunk:
+                continue
+            ctx.controller.check()
+            written += len(chunk)
+            if ctx.max_image_size and written > ctx.max_image_size:
+                raise ImageTooLargeError(f"已接收 {written} 字节，超过上限 {ctx.max_image_size}")
+            f.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+    return written, digest.hexdigest() if digest is not None else None
+
+
+class _SegmentAborted(Exception):
+    """其他分段失败，本分段提前结束"""
+
+
+def _segmentable(ctx, response):
+    """响应是否适合分段并行下载：支持 Range、长度已知且超过阈值、没有内容编码"""
+    if ctx.segments <= 1 or response.status_code != 200:
+        return False
+    length = response.headers.get("Content-Length", "")
+    return (
+        "bytes" in response.headers.get("Accept-Ranges", "").lower()
+        and length.isdigit() and int(length) >= ctx.segment_threshold
+        and response.headers.get("Content-Encoding", "identity").lower() == "identity"
+    )
+
+
+def _fetch_segment(ctx, img_url, part_path, end, validator, progress, number, stop, response=None):
+    """下载一个分段写入断点文件的对应位置，progress[number] 为该分段已写到的位置
+
+    失败时从已写入处重新请求剩余部分，不影响其他分段。response 为已打开的
+    响应（第一个分段复用最初的请求）。
+    """
+    attempt = 0
+    with open(part_path, "r+b") as f:
+        while progress[number] <= end:
+            position = progress[number]
+            try:
+                if response is None:
+                    headers = {"Range": f"bytes={position}-{end}"}
+                    if validator:
+                        headers["If-Range"] = validator
+                    response = limited_get(
+                        ctx.session, img_url, ctx.rate_limiter, ctx.controller,
+                        headers=headers, timeout=ctx.timeout, stream=True
+                    )
+                    content_range = response.headers.get("Content-Range", "")
+                    if response.status_code != 206 or not content_range.startswith(f"bytes {position}-"):
+                        response.close()
+                        response.raise_for_status()
+                        raise requests.exceptions.RequestException(
+                            f"分段请求未返回预期的范围: {response.status_code} {content_range}"
+                        )
+                with response, ctx.controller.track(response):
+                    f.seek(position)
+                    for chunk in response.iter_content(chunk_size=ctx.chunk_size):
+                        if stop.is_set():
+                            raise _SegmentAborted()
+                        ctx.controller.check()
+                        # 第一个分段的响应包含整张图片，只取本分段的部分
+                        chunk = chunk[:end + 1 - progress[number]]
+                        f.write(chunk)
+                        progress[number] += len(chunk)
+                        if progress[number] > end:
+                            break
+                response = None
+                if progress[number] <= end:
+                    raise requests.exceptions.RequestException(f"分段数据不完整: {progress[number]}/{end + 1}")
+            except requests.exceptions.RequestException as e:
+                response = None
+                if ctx.controller.cancelled:
+                    raise JobCancelled()
+                attempt += 1
+                if attempt >= ctx.max_retries or stop.is_set():
+                    raise
+                delay = _retry_delay(e, attempt - 1)
+                ctx.emit("image_retry", url=img_url, attempt=attempt, error=str(e), delay=delay, segment=number)
+                if ctx.controller.sleep(delay):
+                    raise JobCancelled()
+
+
+def _download_segmented(ctx, img_url, response, part_path, segments):
+    """把图片分成 segments 个字节范围并发下载，返回 (总字节数, sha256)
+
+    每个分段单独重试。整体失败或取消时断点文件截断到从头开始连续完成的部分，
+    之后仍可按普通方式续传。
+    """
+    size = int(response.headers["Content-Length"])
+    if ctx.max_image_size and size > ctx.max_image_size:
+        response.close()
+        raise ImageTooLargeError(f"Content-Length {size} 超过上限 {ctx.max_image_size}")
+    validator = _response_validator(response)
+    with open(part_path, "wb") as f:
+        f.truncate(size)
+
+    step = -(-size // segments)
+    bounds = [(start, min(size, start + step) - 1) for start in range(0, size, step)]
+    progress = [start for start, _ in bounds]
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=max(1, len(bounds) - 1))
+    futures = [
+        pool.submit(_fetch_segment, ctx, img_url, part_path, end, validator, progress, number, stop)
+        for number, (_, end) in enumerate(bounds) if number
+    ]
+    try:
+        _fetch_segment(ctx, img_url, part_path, bounds[0][1], validator, progress, 0, stop, response)
+        for future in futures:
+            future.result()
+    except BaseException:
+        stop.set()
+        wait(futures)
+        completed = 0
+        for (start, end), position in zip(bounds, progress):
+            completed = position
+            if position <= end:
+                break
+        with open(part_path, "r+b") as f:
+            f.truncate(completed)
+        raise
+    finally:
+        pool.shutdown(wait=True)
+
+    digest = _hash_file(part_path, ctx.chunk_size).hexdigest() if ctx.hash_content else None
+    return size, digest
+
+
+def _part_lock(part_path):
+    """同一 URL 同时只允许一个线程写断点文件"""
+    with _state_lock:
+        lock = _PART_LOCKS.get(part_path)
+        if lock is None:
+            lock = _PART_LOCKS[part_path] = threading.Lock()
+        return lock
+
+
+def _retry_delay(error, attempt):
+    """重试前的等待时间：服务器给出 Retry-After 时遵守，否则指数退避加抖动"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            return retry_after
+    return backoff_delay(attempt)
+
+
+def _download_one(idx, total_images, img_url, img_name, ctx, revalidate=False):
+    """下载单张图片，img_name 为已在 ctx.names 中预留的文件名，未使用时释放；
+    为 None 时下载完成后按内容哈希命名。
+
+    返回 "downloaded"、"unchanged"、"skipped"、"failed" 或 "cancelled"。
+    """
+    outcome = _fetch_image(idx, total_images, img_url, img_name, ctx, revalidate)
+    if outcome != "downloaded" and img_name is not None:
+        ctx.names.release(img_name)
+    return outcome
+
+
+def _fetch_image(idx, total_images, img_url, img_name, ctx, revalidate=False):
+    """下载单张图片，失败时按次数重试，重试和重新运行时从断点续传
+
+    revalidate 为 True 表示图片已下载过，用条件请求确认是否有更新。
+    total_images 为 None 表示该页图片总数未知（流式解析）。
+    """
+    position = f"{idx + 1}/{total_images}" if total_images else f"{idx + 1}"
+    part_path, meta_path = _partial_paths(ctx, img_url)
+    started = time.monotonic()
+    for attempt in range(ctx.max_retries):
+        if ctx.controller.wait_if_paused():
+            return "cancelled"
+        # 同一图片可能出现在多个分页中，排队期间已被其他线程下载完成
+        if not revalidate and ctx.index.contains(img_url):
+            return "skipped"
+
+        try:
+            with ctx.host_limiter.slot(img_url), _part_lock(part_path):
+                response, offset = _open_image(ctx, img_url, part_path, meta_path, revalidate)
+                if offset is None:
+                    ctx.emit("image_skipped", url=img_url, reason="unchanged", position=position)
+                    return "unchanged"
+                ctx.emit("image_started", url=img_url, position=position, attempt=attempt, offset=offset)
+                if offset == 0 and _segmentable(ctx, response):
+                    # 分段请求也计入每主机的并发数：只使用当前空闲的名额，不等待，
+                    # 避免等待自己占用的名额而死锁，连接数也不会超过连接池大小
+                    with ctx.host_limiter.spare_slots(img_url, ctx.segments - 1) as spare:
+                        size, sha256 = _download_segmented(ctx, img_url, response, part_path, spare + 1)
+                else:
+                    with response, ctx.controller.track(response):
+                        size, sha256 = _stream_to_part(response, part_path, offset, ctx)
+
+                content_named = img_name is None
+                if content_named:
+                    if sha256 is None:
+                        # 按内容命名的任务（例如共享队列中的任务）在未开启 hash_content 时也需要哈希
+                        sha256 = _hash_file(part_path, ctx.chunk_size).hexdigest()
+                    img_name = generate_filename(img_url, "hash", content_hash=sha256)
+                img_path, dedup = ctx.sink.store(part_path, img_url, img_name, sha256, content_named)
+                try:
+                    ctx.index.add(img_url, img_path, size=size, sha256=sha256)
+                except LeaseLost:
+                    # 共享队列中租约过期后图片已由其他进程完成，丢弃本次新建的文件。按内容命名的
+                    # 文件同名即同内容，其他进程的记录可能指向它，保留不删
+                    if not content_named and dedup != "manifest" and os.path.isfile(img_path):
+                        os.remove(img_path)
+                    _discard_partial(part_path, meta_path)
+                    ctx.emit("image_skipped", url=img_url, reason="leased", position=position)
+                    return "skipped"
+                if ctx.cache:
+                    ctx.cache.store(img_url, response)
+                _discard_partial(part_path, meta_path)
+            ctx.emit(
+                "image_done", url=img_url, path=img_path, position=position, bytes=size - offset,
+                ttfb=response.elapsed.total_seconds(), elapsed=time.monotonic() - started, retries=attempt,
+                dedup=dedup
+            )
+            if ctx.postprocess and dedup is None:
+                # 后处理排队已满时在这里等待；主机连接槽位已经释放
+                ctx.postprocess(idx, total_images, img_url, None if content_named else os.path.basename(img_path),
+                                img_path)
+            # 添加下载间隔
+            ctx.controller.sleep(ctx.download_interval)
+            return "downloaded"
+        except JobCancelled:
+            # 已写入的部分保留在断点文件中，下次运行时续传
+            return "cancelled"
+        except ImageTooLargeError as e:
+            _discard_partial(part_path, meta_path)
+            ctx.emit("image_failed", url=img_url, error=str(e), reason="too_large", retries=attempt)
+            return "failed"
+        except requests.exceptions.RequestException as e:
+            if ctx.controller.cancelled:
+                # 取消时连接被中断，不算作下载失败
+                return "cancelled"
+            if attempt == ctx.max_retries - 1:
+                ctx.emit("image_failed", url=img_url, error=str(e), reason="error", retries=ctx.max_retries)
+            else:
+                delay = _retry_delay(e, attempt)
+                ctx.emit("image_retry", url=img_url, attempt=attempt + 1, error=str(e), delay=delay)
+                if ctx.controller.sleep(delay):
+                    return "cancelled"
+        except OSError as e:
+            # requests 的异常也是 OSError 的子类，必须放在其后
+            ctx.emit("image_failed", url=img_url, error=str(e), reason="write", retries=attempt)
+            return "failed"
+    return "failed"
+
+
+def _message_listener(progress_callback):
+    """把事件转换为文字后交给 progress_callback"""
+    if progress_callback is None:
+        return None
+
+    def listener(event):
+        message = render_message(event)
+        if message is not None:
+            progress_callback(message)
+    return listener
+
+
+class _PendingDownloads:
+    """限制已提交但未完成的下载数量，下载完成时累计到统计字典
+
+    下载函数抛出意外异常时算作失败，并通过 emitter 发出 image_failed 事件。
+    下载线程和提交线程都会更新统计字典，统一通过 count() 在锁内修改。
+    """
+
+    def __init__(self, stats, limit, emitter=None):
+        self.stats = stats
+        self.limit = max(1, limit)
+        self.emitter = emitter
+        self._cond = threading.Condition()
+        self._pending = 0
+
+    def submit(self, executor, img_url, fn, *args):
+        """提交图片 img_url 的下载任务，未完成任务过多时阻塞，让网页抓取等待下载进度"""
+        with self._cond:
+            while self._pending >= self.limit:
+                self._cond.wait(0.5)
+            self._pending += 1
+        executor.submit(fn, *args).add_done_callback(lambda future: self._done(future, img_url))
+
+    def count(self, key, delta=1):
+        """在锁内累加统计字典中的一项"""
+        with self._cond:
+            self.stats[key] += delta
+
+    def _done(self, future, img_url):
+        outcome = "failed"
+        try:
+            outcome = future.result()
+        except Exception as e:
+            # 例如下载记录数据库出错；不计数的话 wait() 会一直等待
+            if self.emitter:
+                self.emitter.emit("image_failed", url=img_url, error=str(e), reason="error", retries=0)
+        finally:
+            with self._cond:
+                if outcome in self.stats:
+                    self.stats[outcome] += 1
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def wait(self):
+        with self._cond:
+            while self._pending:
+                self._cond.wait(0.5)
+
+
+class _PostProcessing:
+    """把本任务新保存的图片提交给共享的 PostProcessor，收集损坏的图片以便重新下载
+
+    每张图片最多重新下载一次，再次损坏时算作失败。
+    """
+
+    def __init__(self, postprocessor, emitter):
+        self.postprocessor = postprocessor
+        self.emitter = emitter
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._corrupt = []
+        self._requeued = set()
+
+    def __call__(self, idx, total_images, img_url, img_name, img_path):
+        with self._cond:
+            self._pending += 1
+        try:
+            future = self.postprocessor.submit(img_path)
+        except BaseException:
+            self._finish()
+            raise
+        future.add_done_callback(lambda f: self._done(f, idx, total_images, img_url, img_name))
+
+    def _done(self, future, idx, total_images, img_url, img_name):
+        try:
+            result = future.result()
+        except Exception as e:
+            # 进程池异常（例如子进程被杀死），图片本身不一定损坏
+            self.emitter.emit("image_processed", url=img_url, path=None, error=str(e))
+            self._finish()
+            return
+        if result["error"] is None:
+            self.emitter.emit(
+                "image_processed", url=img_url, path=result["path"], error=result["output_error"],
+                thumbnail=result["thumbnail"], webp=result["webp"], elapsed=result["elapsed"]
+            )
+        else:
+            with self._cond:
+                requeue = img_url not in self._requeued
+                self._requeued.add(img_url)
+                self._corrupt.append((idx, total_images, img_url, img_name, result["path"], requeue))
+            self.emitter.emit("image_corrupt", url=img_url, path=result["path"], error=result["error"],
+                              requeued=requeue)
+        self._finish()
+
+    def _finish(self):
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def wait(self):
+        """等待已提交的图片处理完成，返回其中损坏的图片并清空列表"""
+        with self._cond:
+            while self._pending:
+                self._cond.wait(0.5)
+            corrupt, self._corrupt = self._corrupt, []
+        return corrupt
+
+
+def _move_aside(path, subdir):
+    """把文件移到所在目录的 subdir 子目录中（不覆盖已有文件），返回新路径"""
+    directory = os.path.join(os.path.dirname(path), subdir)
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, name_index(directory).reserve(os.path.basename(path)))
+    try:
+        os.replace(path, target)
+    except FileNotFoundError:
+        pass
+    return target
+
+
+def _job_directories(url, save_dir):
+    """返回 (域名目录, 本次任务的带时间戳保存目录)"""
+    # 解析域名和生成时间戳
+    parsed_url = urlparse(url)
+    domain = parsed_url.netloc if parsed_url.netloc else "unknown_domain"
+    timestamp = time.strftime("%Y-%m-%d-%H%M")
+    domain_dir = os.path.join(save_dir, domain)
+    return domain_dir, os.path.join(domain_dir, timestamp)
+
+
+def _partial_dir(image_dir):
+    """未下载完成的图片放在域名目录下不带时间戳的目录中，重新运行时也能续传"""
+    partial_dir = os.path.join(os.path.dirname(image_dir), ".partial")
+    os.makedirs(partial_dir, exist_ok=True)
+    return partial_dir
+
+
+def _update_watch_state(watch_state, index, parsed_pages, image_pages):
+    """记录已完成的图片；有图片未完成的分页不记录，下次检查时重新解析"""
+    done = {img_url for img_url in image_pages if index.contains(img_url)}
+    watch_state.known_urls.update(done)
+    unfinished = {page_url for img_url, page_url in image_pages.items() if img_url not in done}
+    for page_url, entry in parsed_pages.items():
+        if page_url in unfinished:
+            watch_state.pages.pop(page_url, None)
+        else:
+            watch_state.pages[page_url] = entry
+
+
 def download_images_from_gallery(
         url,
         gallery_selector,
@@ -55,121 +732,465 @@ def download_images_from_gallery(
         timeout=10,
         max_retries=3,
         progress_callback=None,
-        download_interval=0  # 添加下载间隔参数
+        download_interval=0,  # 添加下载间隔参数
+        workers=4,
+        per_host_limit=4,
+        session=None,
+        chunk_size=64 * 1024,
+        max_image_size=None,
+        index_path=None,
+        index=None,
+        hash_content=False,
+        use_cache=True,
+        cache_dir=None,
+        cache_max_bytes=64 * 1024 * 1024,
+        revalidate=False,
+        http_cache=None,
+        executor=None,
+        host_limiter=None,
+        next_selector=None,
+        max_pages=1,
+        page_workers=2,
+        parser_backend="auto",
+        subtree=False,
+        streaming=False,
+        rate_limiter=None,
+        event_callback=None,
+        events_path=None,
+        metrics=None,
+        emitter=None,
+        controller=None,
+        dedup=None,
+        archive=None,
+        shard_size=1024 * 1024 * 1024,
+        segments=1,
+        segment_threshold=16 * 1024 * 1024,
+        postprocessor=None,
+        watch_state=None
 ):
-    """下载画廊图片，支持暂停和继续"""
-    global is_paused, stop_download, DOWNLOADED_FILES
+    """下载画廊图片，支持暂停和继续
+
+    workers 为并发下载线程数，per_host_limit 限制同一主机的同时连接数。
+    session 为共享的 HTTP 会话，未指定时按 per_host_limit 创建连接池。
+    图片按 chunk_size 字节分块写入磁盘，max_image_size（字节）超出时放弃该图片。
+    已下载记录按图片 URL 保存在 index_path（默认 <save_dir>/<域名>/downloaded.sqlite3），
+    重新运行时跳过已记录的图片；也可传入共享的 DownloadIndex 实例。
+    hash_content 为 True 时同时记录图片内容的 SHA-256。
+    dedup 为 "link" 或 "manifest" 时按内容去重：与已下载图片（同一下载记录中）内容
+    相同的图片创建硬链接，或只记录指向已有文件的路径；naming_option 为 "hash" 时
+    以内容的 SHA-256 命名。两者都会开启 hash_content。
+    archive 为 "tar" 或 "zip" 时图片不再保存为单独的文件，而是依次写入保存目录中的
+    分片（每个分片约 shard_size 字节），index.jsonl 记录每张图片所在的分片和偏移。
+    segments 大于 1 时，服务器支持 Range 且大小不小于 segment_threshold 字节的图片
+    分成最多 segments 段并发下载，每段单独重试；分段数受该主机空闲的并发名额限制。
+    postprocessor 为 postprocess.PostProcessor 实例时，新保存的图片在进程池中校验、
+    生成缩略图或转换格式，损坏或不完整的图片删除后重新下载一次（不支持 archive）。
+    watch_state（watch.WatchState）用于定期检查同一画廊：上次已完成的图片直接忽略，
+    返回 304 的已知分页不再解析，所有检查共用同一个保存目录。
+    use_cache 开启磁盘 HTTP 缓存（默认 <save_dir>/.http_cache，上限 cache_max_bytes），
+    网页未变化时不再重新下载；revalidate 为 True 时对已下载的图片发送条件请求，
+    只重新下载服务器上有更新的图片。也可传入共享的 HTTPCache 实例。
+    executor 和 host_limiter 可在多个画廊任务之间共享，用于限制全局并发。
+    max_pages 大于 1 时沿翻页链接（next_selector 指定的 CSS 选择器，默认 rel=next）
+    抓取最多 max_pages 个分页，page_workers 个线程在下载图片的同时抓取后续分页。
+    selector_type 可为 id、class 或 css；parser_backend 选择 HTML 解析器（auto 时
+    优先 lxml），subtree 为 True 时只构建画廊元素的子树。
+    streaming 为 True 时边接收网页边解析，发现图片即开始下载（不使用网页缓存）。
+    rate_limiter 为 HostRateLimiter 实例时按主机自适应限速，可在多个任务间共享。
+
+    下载过程以结构化事件的形式输出（见 events.py）：event_callback 接收事件字典，
+    events_path 把事件追加写入 JSONL 文件，metrics（events.Metrics）累计计数器和
+    直方图；progress_callback 接收由事件生成的文字信息。emitter 为多个任务共享的
+    EventEmitter，以上监听者会附加到它上面。
+
+    controller（job_control.JobController）用于暂停、继续和取消本次任务，取消时
+    正在进行的传输立即中断，已接收的部分保留供下次续传。
+
+    返回本次任务的统计字典：total、downloaded、unchanged、skipped、failed，
+    网页无法访问或找不到画廊时 error 字段为错误说明。
+    """
+    stats = {"url": url, "total": 0, "downloaded": 0, "unchanged": 0,
+             "skipped": 0, "failed": 0, "error": None}
+    events_writer = JsonlWriter(events_path) if events_path else None
+    emitter = (emitter or EventEmitter()).child(
+        [_message_listener(progress_callback), event_callback, events_writer, metrics]
+    )
+    if controller is None:
+        controller = JobController()
+    hash_content = hash_content or bool(dedup) or naming_option == "hash"
+    emitter.emit("job_started", url=url)
+    try:
+        if dedup not in (None, "link", "manifest"):
+            raise ValueError(f"无效的去重方式: {dedup}")
+        if archive not in (None,) + ARCHIVE_FORMATS:
+            raise ValueError(f"无效的分片格式: {archive}")
+        if archive and postprocessor:
+            raise ValueError("后处理只支持保存为单独的图片文件，不能与分片输出同时使用")
+        parser = GalleryParser(gallery_selector, selector_type, parser_backend, subtree, next_selector)
+        if streaming:
+            parser.streaming(want_links=max_pages > 1)
+    except ValueError as e:
+        emitter.emit("job_error", url=url, error=str(e))
+        stats["error"] = str(e)
+        if events_writer:
+            events_writer.close()
+        return stats
 
     if save_dir is None:
         save_dir = "downloaded_images"
-    # 解析域名和生成时间戳
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc if parsed_url.netloc else "unknown_domain"
-    timestamp = time.strftime("%Y-%m-%d-%H%M")
-    new_save_dir = os.path.join(save_dir, domain, timestamp)
+    domain_dir, new_save_dir = _job_directories(url, save_dir)
+    if watch_state:
+        new_save_dir = watch_state.directory = watch_state.directory or new_save_dir
     os.makedirs(new_save_dir, exist_ok=True)
+    partial_dir = _partial_dir(new_save_dir)
 
-    DOWNLOADED_FILES = load_downloaded_files(new_save_dir)
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
+    if session is None:
+        session = create_session(pool_size=max(1, per_host_limit))
+    own_cache = http_cache is None and use_cache
+    if own_cache:
+        http_cache = HTTPCache(cache_dir or os.path.join(save_dir, ".http_cache"), cache_max_bytes)
+    # 共享的缓存累计所有任务的次数，本任务只报告增加的部分
+    cache_counts = (http_cache.hits, http_cache.misses) if http_cache else None
 
+    own_index = index is None
+    if own_index:
+        index = DownloadIndex(index_path or os.path.join(domain_dir, "downloaded.sqlite3"))
+    names = name_index(new_save_dir)
+    if watch_state:
+        # 保持引用，下次检查不必重新扫描目录
+        watch_state.names = names
+    if archive:
+        sink = ShardSink(new_save_dir, archive, shard_size, index, dedup)
+    else:
+        sink = DirectorySink(new_save_dir, names, index, dedup)
+    ctx = _DownloadContext(
+        new_save_dir, partial_dir, session, host_limiter or HostLimiter(per_host_limit), index,
+        controller=controller,
+        cache=http_cache,
+        rate_limiter=rate_limiter,
+        timeout=timeout,
+        max_retries=max_retries,
+        emitter=emitter,
+        download_interval=download_interval,
+        chunk_size=chunk_size,
+        max_image_size=max_image_size,
+        hash_content=hash_content,
+        segments=segments,
+        segment_threshold=segment_threshold,
+        names=names,
+        sink=sink,
+        postprocess=_PostProcessing(postprocessor, emitter) if postprocessor else None
+    )
+    crawler = GalleryCrawler(
+        session, url, parser,
+        max_pages=max_pages,
+        page_workers=page_workers,
+        timeout=timeout,
+        cache=None if streaming else http_cache,
+        emitter=emitter,
+        streaming=streaming,
+        chunk_size=chunk_size,
+        rate_limiter=rate_limiter,
+        controller=controller,
+        known_pages=watch_state.pages if watch_state else None
+    )
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = _PendingDownloads(stats, max(1, workers) * 4, emitter)
+    interrupted = False
+    # 本次解析的分页及其记录，提交下载的图片所在的分页
+    parsed_pages = {}
+    image_pages = {}
     try:
-        response = requests.get(url, headers=headers, timeout=timeout)
-        response.raise_for_status()
+        for kind, page_url, *payload in crawler.events():
+            if controller.cancelled:
+                break
+
+            if kind == "page":
+                count, next_pages, unchanged = payload
+                if not unchanged:
+                    parsed_pages[page_url] = (count, next_pages)
+                emitter.emit(
+                    "page_fetched", url=page_url, images=count, unchanged=unchanged,
+                    selector_type=selector_type, selector=gallery_selector
+                )
+                continue
+
+            idx, img_src, page_total = payload
+            img_url = urljoin(page_url, img_src)
+            if watch_state:
+                if img_url in watch_state.known_urls:
+                    continue
+                image_pages[img_url] = page_url
+            pending.count("total")
+            # 按 URL 判断是否已下载，不依赖本次生成的文件名
+            downloaded = index.contains(img_url)
+            if downloaded and not (revalidate and http_cache):
+                position = f"{idx + 1}/{page_total}" if page_total else f"{idx + 1}"
+                emitter.emit("image_skipped", url=img_url, reason="downloaded", position=position)
+                pending.count("skipped")
+                continue
+
+            try:
+                # hash 命名要等内容下载完成后才能确定文件名
+                img_name = None if naming_option == "hash" else \
+                    generate_filename(img_url, naming_option, custom_prefix, ctx.names)
+            except ValueError as e:
+                emitter.emit("image_failed", url=img_url, error=str(e), reason="filename", retries=0)
+                pending.count("failed")
+                continue
+
+            pending.submit(executor, img_url, _download_one, idx, page_total, img_url, img_name, ctx, downloaded)
+        pending.wait()
+        while ctx.postprocess:
+            corrupt = ctx.postprocess.wait()
+            if not corrupt or controller.cancelled:
+                break
+            for idx, page_total, img_url, img_name, img_path, requeue in corrupt:
+                pending.count("downloaded", -1)
+                index.remove(img_url)
+                if requeue:
+                    try:
+                        os.remove(img_path)
+                    except FileNotFoundError:
+                        pass
+                    pending.submit(executor, img_url, _download_one, idx, page_total, img_url, img_name, ctx)
+                else:
+                    # 不删除文件（校验也可能误判），移到 corrupt 子目录中由用户检查
+                    kept_path = _move_aside(img_path, "corrupt")
+                    emitter.emit("image_failed", url=img_url, error=f"图片损坏，已移到 {kept_path}",
+                                 reason="corrupt", retries=1)
+                    pending.count("failed")
+            pending.wait()
+        if watch_state and not controller.cancelled:
+            _update_watch_state(watch_state, index, parsed_pages, image_pages)
     except requests.exceptions.RequestException as e:
-        if progress_callback:
-            progress_callback(f"无法访问网页: {e}")
-        return
-
-    soup = BeautifulSoup(response.text, 'html.parser')
-    if selector_type == "id":
-        gallery = soup.find(id=gallery_selector)
-    elif selector_type == "class":
-        gallery = soup.find(class_=gallery_selector)
-    else:
-        if progress_callback:
-            progress_callback("无效的选择器类型，请使用 'id' 或 'class'")
-        return
-
-    if not gallery:
-        if progress_callback:
-            progress_callback(f"未找到 {selector_type} 为 '{gallery_selector}' 的画廊")
-        return
-
-    img_tags = gallery.find_all('img')
-    if not img_tags:
-        if progress_callback:
-            progress_callback("画廊中没有找到图片")
-        return
-
-    total_images = len(img_tags)
-    for idx, img in enumerate(img_tags):
-        if stop_download:
-            if progress_callback:
-                progress_callback("用户取消下载，程序退出。")
-            return
+        # 只有起始页失败会抛出，分页失败由爬虫自行报告
+        emitter.emit("page_failed", url=url, error=str(e), start=True)
+        stats["error"] = f"无法访问网页: {e}"
+    except KeyboardInterrupt:
+        interrupted = True
+        controller.cancel()
+        emitter.emit("job_cancelled", url=url, interrupted=True)
+        pending.wait()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+        # 共享线程池时仍可能有未完成的下载在写入分片
+        pending.wait()
+        if ctx.postprocess:
+            ctx.postprocess.wait()
+        sink.close()
+        if own_index:
+            index.close()
+        else:
+            index.flush()
+        if own_cache:
+            http_cache.close()
 
-        while is_paused:
-            if stop_download:
-                return
-            time.sleep(0.5)
+    if not stats["error"] and not stats["total"] and not (watch_state and watch_state.pages):
+        stats["error"] = "未找到画廊或画廊中没有图片"
+    if controller.cancelled and not interrupted:
+        emitter.emit("job_cancelled", url=url, interrupted=False)
+    done = dict(stats)
+    done.pop("error")
+    if http_cache:
+        done.update(cache_hits=http_cache.hits - cache_counts[0], cache_misses=http_cache.misses - cache_counts[1])
+    emitter.emit("job_done", **done)
+    if events_writer:
+        events_writer.close()
+    return stats
 
-        img_url = img.get('src')
-        if not img_url:
-            continue
 
-        img_url = urljoin(url, img_url)
-        try:
-            img_name = generate_filename(img_url, naming_option, custom_prefix)
-        except ValueError as e:
-            if progress_callback:
-                progress_callback(f"文件名生成失败: {e}")
-            continue
-
-        if img_name in DOWNLOADED_FILES:
-            if progress_callback:
-                progress_callback(f"跳过已下载: {img_name}")
-            continue
-
-        for attempt in range(max_retries):
-            if stop_download:
-                return
-
-            while is_paused:
-                if stop_download:
-                    return
-                time.sleep(0.5)
+def enqueue_gallery(
+        url,
+        gallery_selector,
+        queue,
+        selector_type="id",
+        save_dir=None,
+        naming_option="original",
+        custom_prefix="",
+        timeout=10,
+        session=None,
+        next_selector=None,
+        max_pages=1,
+        page_workers=2,
+        parser_backend="auto",
+        subtree=False,
+        rate_limiter=None,
+        emitter=None,
+        controller=None
+):
+    """抓取画廊的分页，把图片加入共享任务队列（task_queue.TaskQueue），由 run_queue_worker 下载
+
+    文件名在这里统一生成和预留，多个进程不会使用相同的文件名；已下载或已在队列中的
+    图片不会重复加入。返回统计字典：total、queued（新加入的任务数），网页无法访问
+    或找不到画廊时 error 为错误说明。
+    """
+    stats = {"url": url, "total": 0, "queued": 0, "error": None}
+    emitter = emitter or EventEmitter()
+    controller = controller or JobController()
+    try:
+        parser = GalleryParser(gallery_selector, selector_type, parser_backend, subtree, next_selector)
+    except ValueError as e:
+        emitter.emit("job_error", url=url, error=str(e))
+        stats["error"] = str(e)
+        return stats
+
+    directory = _job_directories(url, save_dir or "downloaded_images")[1]
+    os.makedirs(directory, exist_ok=True)
+    names = name_index(directory)
+    crawler = GalleryCrawler(
+        session or create_session(), url, parser,
+        max_pages=max_pages,
+        page_workers=page_workers,
+        timeout=timeout,
+        emitter=emitter,
+        rate_limiter=rate_limiter,
+        controller=controller
+    )
+    tasks = []
+    try:
+        for kind, page_url, *payload in crawler.events():
+            if kind == "page":
+                emitter.emit(
+                    "page_fetched", url=page_url, images=payload[0], unchanged=False,
+                    selector_type=selector_type, selector=gallery_selector
+                )
+                continue
 
+            idx, img_src, page_total = payload
+            stats["total"] += 1
+            img_url = urljoin(page_url, img_src)
+            if queue.contains(img_url):
+                emitter.emit("image_skipped", url=img_url, reason="downloaded", position=f"{idx + 1}")
+                continue
             try:
-                img_data = requests.get(img_url, headers=headers, timeout=timeout).content
-                img_path = os.path.join(new_save_dir, img_name)
+                img_name = None if naming_option == "hash" else \
+                    generate_filename(img_url, naming_option, custom_prefix, names)
+            except ValueError as e:
+                emitter.emit("image_failed", url=img_url, error=str(e), reason="filename", retries=0)
+                continue
+            tasks.append((img_url, directory, img_name, idx))
+            if len(tasks) >= 500:
+                stats["queued"] += queue.enqueue(tasks)
+                tasks = []
+        stats["queued"] += queue.enqueue(tasks)
+    except requests.exceptions.RequestException as e:
+        emitter.emit("page_failed", url=url, error=str(e), start=True)
+        stats["error"] = f"无法访问网页: {e}"
+    if not stats["error"] and not stats["total"]:
+        stats["error"] = "未找到画廊或画廊中没有图片"
+    emitter.emit("job_queued", url=url, total=stats["total"], queued=stats["queued"])
+    return stats
 
-                counter = 1
-                while os.path.exists(img_path):
-                    name, ext = os.path.splitext(img_name)
-                    img_path = os.path.join(save_dir, f"{name}_{counter}{ext}")
-                    counter += 1
 
-                with open(img_path, 'wb') as f:
-                    f.write(img_data)
-                save_downloaded_file(new_save_dir, img_name)
-                if progress_callback:
-                    progress_callback(f"下载成功 ({idx + 1}/{total_images}): {img_path}")
-                # 添加下载间隔
-                if download_interval > 0:
-                    time.sleep(download_interval)
-                break
-            except (requests.exceptions.RequestException, KeyboardInterrupt) as e:
-                if isinstance(e, KeyboardInterrupt):
-                    if progress_callback:
-                        progress_callback("\n用户中断下载，程序退出。")
-                    return
-                if attempt == max_retries - 1:
-                    if progress_callback:
-                        progress_callback(f"下载失败（重试 {max_retries} 次）: {img_url}, 错误: {e}")
-                else:
-                    if progress_callback:
-                        progress_callback(f"下载失败（第 {attempt + 1} 次重试）: {img_url}, 错误: {e}")
-                    time.sleep(1)
+def _run_task(queue, task, ctx):
+    img_url, _, img_name, position = task
+    outcome = "failed"
+    try:
+        outcome = _download_one(position, None, img_url, img_name, ctx)
+    finally:
+        # 出现意外异常时也要交还租约，否则任务会被本进程一直续租
+        queue.finish(img_url, outcome)
+    return outcome
+
+
+def run_queue_worker(
+        queue,
+        workers=4,
+        per_host_limit=4,
+        session=None,
+        idle_timeout=10,
+        timeout=10,
+        max_retries=3,
+        chunk_size=64 * 1024,
+        max_image_size=None,
+        hash_content=False,
+        dedup=None,
+        segments=1,
+        segment_threshold=16 * 1024 * 1024,
+        download_interval=0,
+        rate_limiter=None,
+        progress_callback=None,
+        event_callback=None,
+        emitter=None,
+        controller=None
+):
+    """作为共享任务队列的一个工作进程下载图片
+
+    每次领取与线程数相同的任务，已提交未完成的任务不超过线程数的两倍，处理快的
+    进程自然领取更多任务；持有的租约由后台线程续期，本进程崩溃后其他进程在租约
+    过期时接手。队列中没有待处理和处理中的任务超过 idle_timeout 秒后返回统计字典：
+    total、downloaded、unchanged、skipped、failed。参数含义与
+    download_images_from_gallery 相同，限速和主机并发只在本进程内生效。
+    """
+    stats = {"total": 0, "downloaded": 0, "unchanged": 0, "skipped": 0, "failed": 0, "error": None}
+    emitter = (emitter or EventEmitter()).child([_message_listener(progress_callback), event_callback])
+    if controller is None:
+        controller = JobController()
+    if session is None:
+        session = create_session(pool_size=max(1, per_host_limit))
+    host_limiter = HostLimiter(per_host_limit)
+    contexts = {}
+
+    def context(directory):
+        # 每个保存目录一个下载上下文，目录中的文件名由加入队列的进程预留
+        ctx = contexts.get(directory)
+        if ctx is None:
+            os.makedirs(directory, exist_ok=True)
+            names = name_index(directory)
+            ctx = contexts[directory] = _DownloadContext(
+                directory, _partial_dir(directory), session, host_limiter, queue,
+                names=names,
+                controller=controller,
+                rate_limiter=rate_limiter,
+                timeout=timeout,
+                max_retries=max_retries,
+                emitter=emitter,
+                download_interval=download_interval,
+                chunk_size=chunk_size,
+                max_image_size=max_image_size,
+                hash_content=hash_content or bool(dedup),
+                segments=segments,
+                segment_threshold=segment_threshold,
+                sink=DirectorySink(directory, names, queue, dedup)
+            )
+        return ctx
+
+    emitter.emit("worker_started", worker=queue.worker_id)
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    pending = _PendingDownloads(stats, max(1, workers) * 2, emitter)
+    idle_since = None
+    with LeaseKeeper(queue):
+        try:
+            while not controller.cancelled:
+                tasks = queue.claim(max(1, workers))
+                if tasks:
+                    idle_since = None
+                    for task in tasks:
+                        pending.count("total")
+                        pending.submit(executor, task[0], _run_task, queue, task, context(task[1]))
+                    continue
+                counts = queue.counts()
+                if counts["pending"] or counts["leased"]:
+                    # 其他进程仍在处理，它们的租约过期时可以接手
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since >= idle_timeout:
+                    break
+                controller.sleep(0.5)
+            pending.wait()
+        except KeyboardInterrupt:
+            controller.cancel()
+            pending.wait()
+        finally:
+            executor.shutdown(wait=True)
+            pending.wait()
+            # 已领取但未开始的任务退回队列
+            queue.release()
+    emitter.emit("worker_done", worker=queue.worker_id, total=stats["total"], downloaded=stats["downloaded"],
+                 unchanged=stats["unchanged"], skipped=stats["skipped"], failed=stats["failed"])
+    return stats
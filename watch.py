@@ -0,0 +1,69 @@
+import os
+import time
+
+from events import EventEmitter
+from http_cache import HTTPCache
+from job_control import JobController
+from util import download_images_from_gallery
+
+
+class WatchState:
+    """定期检查同一画廊时，在多次检查之间保留的状态
+
+    known_urls 为已完成的图片 URL；pages 记录图片都已完成的分页
+    {分页 URL: (图片数, 翻页链接)}，这些分页返回 304 时不再解析；
+    directory 为所有检查共用的保存目录。
+    """
+
+    def __init__(self):
+        self.known_urls = set()
+        self.pages = {}
+        self.directory = None
+        self.names = None
+
+
+def watch_gallery(url, gallery_selector, interval, controller=None, emitter=None, max_polls=None, **options):
+    """每隔 interval 秒检查一次画廊，只下载新出现的图片，直到任务被取消
+
+    每次检查用条件请求获取网页，网页未变化时既不重新下载也不解析；网页变化时
+    与上一次的图片集合比较，只下载新增的图片。每次检查结束时发出 poll_done 事件。
+    options 为 download_images_from_gallery 的其他参数。max_polls 限制检查次数，
+    返回最后一次检查的统计字典。
+    """
+    controller = controller or JobController()
+    emitter = emitter or EventEmitter()
+    # 条件请求依赖 HTTP 缓存，所有检查共用同一个
+    own_cache = options.get("use_cache", True) and options.get("http_cache") is None
+    if own_cache:
+        save_dir = options.get("save_dir") or "downloaded_images"
+        options["http_cache"] = HTTPCache(
+            options.get("cache_dir") or os.path.join(save_dir, ".http_cache"),
+            options.get("cache_max_bytes", 64 * 1024 * 1024)
+        )
+    state = WatchState()
+    poll = 0
+    stats = None
+    try:
+        while not controller.cancelled:
+            poll += 1
+            started = time.monotonic()
+            stats = download_images_from_gallery(
+                url, gallery_selector,
+                emitter=emitter.child(poll=poll),
+                controller=controller,
+                watch_state=state,
+                **options
+            )
+            emitter.emit(
+                "poll_done", url=url, poll=poll, new=stats["total"], downloaded=stats["downloaded"],
+                failed=stats["failed"], error=stats["error"], elapsed=time.monotonic() - started,
+                known=len(state.known_urls), next_in=interval
+            )
+            if max_polls and poll >= max_polls:
+                break
+            if controller.sleep(interval):
+                break
+    finally:
+        if own_cache:
+            options["http_cache"].close()
+    return stats